@@ -1,22 +1,46 @@
 from fastapi import FastAPI, HTTPException, APIRouter, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pydantic import BaseModel, Field, PrivateAttr
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
 from datetime import datetime
 import datetime as dt
 import os
 import json
-import requests
+import httpx
 import logging
 from pathlib import Path
 import aiofiles
 import asyncio
 import re
 import random
+import time
+import math
+import bisect
+import hashlib
+import secrets
+import unicodedata
+from collections import OrderedDict, deque
+import numpy as np
 from dotenv import load_dotenv
 load_dotenv()
 
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+try:
+    import scipy.sparse as sp
+except ImportError:
+    sp = None
+
+try:
+    from sklearn.cluster import MiniBatchKMeans
+except ImportError:
+    MiniBatchKMeans = None
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -27,6 +51,7 @@ logging.basicConfig(
     ]
 )
 logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Загрузка переменных окружения
 from dotenv import load_dotenv
@@ -38,6 +63,77 @@ DB_NAME = os.getenv("DB_NAME", "ai_sexter_bot")
 client = AsyncIOMotorClient(MONGO_URL)
 db = client[DB_NAME]
 
+# Ollama подключение
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.2:1b")
+# Несколько endpoint'ов через запятую: "url|model|weight", например "http://10.0.0.2:11434|llama3.2:1b|2,http://10.0.0.3:11434"
+OLLAMA_ENDPOINTS = os.getenv("OLLAMA_ENDPOINTS", "")
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "10"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "2"))
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "32"))
+OLLAMA_MAX_KEEPALIVE = int(os.getenv("OLLAMA_MAX_KEEPALIVE", "16"))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "60"))
+OLLAMA_STREAM = os.getenv("OLLAMA_STREAM", "true").lower() in ("1", "true", "yes")
+OLLAMA_NUM_PREDICT = int(os.getenv("OLLAMA_NUM_PREDICT", "10"))
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+OLLAMA_BREAKER_FAILURES = int(os.getenv("OLLAMA_BREAKER_FAILURES", "3"))
+OLLAMA_BREAKER_RESET = float(os.getenv("OLLAMA_BREAKER_RESET", "30"))
+OLLAMA_PROBE_INTERVAL = float(os.getenv("OLLAMA_PROBE_INTERVAL", "5"))
+OLLAMA_PROBE_TIMEOUT = float(os.getenv("OLLAMA_PROBE_TIMEOUT", "2"))
+
+# Планировщик генераций LLM
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "0"))  # 0 - по 2 генерации на endpoint
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "16"))
+LLM_INITIAL_LATENCY = float(os.getenv("LLM_INITIAL_LATENCY", "1.5"))
+CHAT_LATENCY_BUDGET = float(os.getenv("CHAT_LATENCY_BUDGET", "8"))
+
+# Кандидаты на один запрос: первый прошедший проверку ответ побеждает
+LLM_CANDIDATES = int(os.getenv("LLM_CANDIDATES", "1"))
+LLM_CANDIDATE_TEMPERATURE = float(os.getenv("LLM_CANDIDATE_TEMPERATURE", "0.7"))
+
+# Параллельный запуск Ollama, если поиск обученного ответа медленнее порога
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "0.05"))
+
+# Пул заранее сгенерированных ответов по намерениям (0 - выключен)
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "0"))
+LLM_POOL_INTERVAL = float(os.getenv("LLM_POOL_INTERVAL", "1"))
+LLM_POOL_BACKOFF = float(os.getenv("LLM_POOL_BACKOFF", "30"))
+
+# Кэш ответов LLM
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "10000"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))
+LLM_CACHE_NEGATIVE_TTL = float(os.getenv("LLM_CACHE_NEGATIVE_TTL", "300"))
+
+# Состояния диалогов в памяти: простой дольше CONVERSATION_TTL секунд или вытеснение по LRU сверх лимита
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", "3600"))
+CONVERSATION_MAX_ENTRIES = int(os.getenv("CONVERSATION_MAX_ENTRIES", "50000"))
+CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "50"))
+CONVERSATION_SWEEP_INTERVAL = float(os.getenv("CONVERSATION_SWEEP_INTERVAL", "60"))
+
+# Опрос версий обученных ответов для синхронизации между воркерами
+TRAINED_SYNC_INTERVAL = float(os.getenv("TRAINED_SYNC_INTERVAL", "2"))
+# false - обученные ответы не держатся в памяти целиком: запросы идут в MongoDB, а заведомые промахи
+# отсекает компактный фильтр Блума по ключам вопросов и 4-граммам их текста
+TRAINED_INDEX_ENABLED = os.getenv("TRAINED_INDEX_ENABLED", "true").lower() in ("1", "true", "yes")
+TRAINED_BLOOM_ERROR_RATE = float(os.getenv("TRAINED_BLOOM_ERROR_RATE", "0.01"))
+# Семантический поиск по эмбеддингам вопросов (нужен sentence-transformers)
+SEMANTIC_ENABLED = SentenceTransformer is not None and os.getenv("SEMANTIC_ENABLED", "true").lower() in ("1", "true", "yes")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "paraphrase-multilingual-MiniLM-L12-v2")
+SEMANTIC_THRESHOLD = float(os.getenv("SEMANTIC_THRESHOLD", "0.8"))
+SEMANTIC_TOP_K = int(os.getenv("SEMANTIC_TOP_K", "5"))
+# С какого числа вопросов модели поиск идёт по кластерам k-means, а не по всей матрице
+SEMANTIC_ANN_MIN_ROWS = int(os.getenv("SEMANTIC_ANN_MIN_ROWS", "20000"))
+SEMANTIC_ANN_NPROBE = int(os.getenv("SEMANTIC_ANN_NPROBE", "16"))
+# Сообщения из параллельных запросов кодируются пачкой: до SEMANTIC_BATCH_SIZE штук или SEMANTIC_BATCH_WAIT_MS ожидания
+SEMANTIC_BATCH_SIZE = int(os.getenv("SEMANTIC_BATCH_SIZE", "32"))
+SEMANTIC_BATCH_WAIT_MS = float(os.getenv("SEMANTIC_BATCH_WAIT_MS", "5"))
+# Минимальный косинус TF-IDF для совпадения по ключевым словам (0 - любое общее слово)
+TRAINED_KEYWORD_MIN_SCORE = float(os.getenv("TRAINED_KEYWORD_MIN_SCORE", "0"))
+# Порог сходства по триграммам для вопросов с опечатками (0 - выключено)
+TRAINED_FUZZY_THRESHOLD = float(os.getenv("TRAINED_FUZZY_THRESHOLD", "0.7"))
+
 # FastAPI приложение
 app = FastAPI(title="AI Sexter Bot API", version="2.0.0")
 api_router = APIRouter(prefix="/api")
@@ -94,6 +190,12 @@ class ModelConfig(BaseModel):
     use_emoji: bool
     personality_traits: List[str] = []
     triggers: List[str] = []
+    trigger_word_boundary: bool = False
+    
+    # Скомпилированные при загрузке данные, не сохраняются в JSON
+    _prompt_prefix: Optional[str] = PrivateAttr(default=None)
+    _trigger_pattern: Optional[re.Pattern] = PrivateAttr(default=None)
+    _trigger_names: Dict[str, str] = PrivateAttr(default_factory=dict)
 
 class TestRequest(BaseModel):
     message: str
@@ -102,10 +204,119 @@ class TestRequest(BaseModel):
 class StatsClearRequest(BaseModel):
     model: str
 
+# Индексы горячих коллекций, создаются при старте
+REQUIRED_INDEXES = {
+    "trained_responses": [
+        IndexModel([("model", ASCENDING), ("question", ASCENDING), ("priority", DESCENDING)], name="model_question_priority"),
+        IndexModel([("model", ASCENDING), ("version", ASCENDING)], name="model_version"),
+        IndexModel(
+            [("model", ASCENDING), ("question_key", ASCENDING)],
+            name="model_question_key_unique",
+            unique=True,
+            partialFilterExpression={"question_key": {"$exists": True}}
+        )
+    ],
+    "trained_versions": [
+        IndexModel([("model", ASCENDING)], name="model_unique", unique=True)
+    ],
+    "conversations": [
+        IndexModel([("model", ASCENDING), ("user_id", ASCENDING)], name="model_user_id"),
+        IndexModel([("user_id", ASCENDING)], name="user_id")
+    ],
+    "ratings": [
+        IndexModel([("model", ASCENDING), ("rating", ASCENDING)], name="model_rating"),
+        IndexModel([("rating", ASCENDING)], name="rating")
+    ],
+    "statistics": [
+        IndexModel([("type", ASCENDING), ("model", ASCENDING)], name="type_model")
+    ],
+    "bot_activities": [
+        IndexModel([("model", ASCENDING)], name="model")
+    ],
+    "user_settings": [
+        IndexModel([("type", ASCENDING)], name="type")
+    ]
+}
+
+# Запросы горячего пути, план которых показывает /api/admin/indexes
+HOT_QUERIES = {
+    "trained_exact": {"find": "trained_responses", "filter": {"model": "", "question_key": ""}, "limit": 1},
+    "trained_sync": {"find": "trained_responses", "filter": {"model": "", "version": {"$gt": 0}}, "sort": {"version": 1}},
+    "conversations_by_model": {"count": "conversations", "query": {"model": ""}},
+    "conversations_users_by_model": {"distinct": "conversations", "key": "user_id", "query": {"model": ""}},
+    "conversations_users": {"distinct": "conversations", "key": "user_id", "query": {}},
+    "ratings_problem_by_model": {"find": "ratings", "filter": {"model": "", "rating": {"$lte": 3}}, "limit": 10},
+    "ratings_problem": {"find": "ratings", "filter": {"rating": {"$lte": 3}}, "limit": 10}
+}
+
+class ConversationStore:
+    """Состояния диалогов (user_id, model) в порядке последней активности: простаивающие дольше ttl
+    удаляет периодическая чистка, сверх max_entries вытесняются самые давние"""
+    
+    def __init__(self, ttl: float, max_entries: int, max_messages: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_messages = max_messages
+        self._states: "OrderedDict[str, dict]" = OrderedDict()
+        self.expired = 0
+        self.evicted = 0
+    
+    def __len__(self) -> int:
+        return len(self._states)
+    
+    def _is_idle(self, state: dict, now: datetime) -> bool:
+        return (now - state["last_activity"]).total_seconds() > self.ttl
+    
+    def get(self, user_id: str, model: str) -> dict:
+        key = f"{user_id}_{model}"
+        now = datetime.now(dt.UTC)
+        state = self._states.get(key)
+        if state is not None and self._is_idle(state, now):
+            # Чистка ещё не дошла до записи, но диалог уже истёк
+            del self._states[key]
+            self.expired += 1
+            state = None
+        if state is None:
+            state = {
+                "message_count": 0,
+                "messages": deque(maxlen=self.max_messages),
+                "last_activity": now
+            }
+            self._states[key] = state
+            while len(self._states) > self.max_entries:
+                self._states.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._states.move_to_end(key)
+        return state
+    
+    def sweep(self) -> int:
+        # Записи упорядочены по обращению, поэтому истёкшие лежат в начале
+        now = datetime.now(dt.UTC)
+        removed = 0
+        while self._states:
+            key, state = next(iter(self._states.items()))
+            if not self._is_idle(state, now):
+                break
+            del self._states[key]
+            removed += 1
+        self.expired += removed
+        return removed
+    
+    def stats(self) -> dict:
+        return {
+            "size": len(self._states),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "expired": self.expired,
+            "evicted": self.evicted
+        }
+
 # Глобальные переменные
 MODELS_DIR = Path(__file__).parent / "models"
+EMBEDDINGS_DIR = Path(os.getenv("EMBEDDINGS_DIR", Path(__file__).parent / "embeddings"))
 loaded_models = {}
-conversation_states = {}
+conversation_states = ConversationStore(CONVERSATION_TTL, CONVERSATION_MAX_ENTRIES, CONVERSATION_MAX_MESSAGES)
 
 # Создание директории для моделей
 MODELS_DIR.mkdir(exist_ok=True)
@@ -127,7 +338,7 @@ async def load_model(model_name: str) -> ModelConfig:
     async with aiofiles.open(model_path, 'r', encoding='utf-8') as f:
         content = await f.read()
         model_data = json.loads(content)
-        model_config = ModelConfig(**model_data)
+        model_config = compile_model_config(ModelConfig(**model_data))
         loaded_models[model_name] = model_config
         logger.info(f"Model {model_name} loaded successfully from JSON")
         return model_config
@@ -137,18 +348,20 @@ async def save_model(model_name: str, config: ModelConfig):
     model_path = MODELS_DIR / f"{model_name}.json"
     async with aiofiles.open(model_path, 'w', encoding='utf-8') as f:
         await f.write(json.dumps(config.model_dump(), ensure_ascii=False, indent=2))
-    loaded_models[model_name] = config
+    loaded_models[model_name] = compile_model_config(config)
+    llm_cache.invalidate_model(model_name)
+    reply_pool.invalidate_model(model_name)
     logger.info(f"Model {model_name} saved successfully")
 
 def get_conversation_state(user_id: str, model: str):
-    key = f"{user_id}_{model}"
-    if key not in conversation_states:
-        conversation_states[key] = {
-            "message_count": 0,
-            "messages": [],
-            "last_activity": datetime.now(dt.UTC)
-        }
-    return conversation_states[key]
+    return conversation_states.get(user_id, model)
+
+async def sweep_conversations_loop():
+    while True:
+        await asyncio.sleep(CONVERSATION_SWEEP_INTERVAL)
+        removed = conversation_states.sweep()
+        if removed:
+            logger.info(f"Удалено неактивных диалогов: {removed}, осталось: {len(conversation_states)}")
 
 def detect_emotion(message: str) -> str:
     message_lower = message.lower()
@@ -163,99 +376,829 @@ def detect_emotion(message: str) -> str:
     else:
         return "neutral"
 
-async def get_ollama_response(message: str, model_config: ModelConfig) -> Optional[str]:
-    try:
-        personality = ", ".join(model_config.personality_traits)
-        interests = ", ".join(model_config.interests)
-        
-        if model_config.language == "ru":
-            prompt = (
-                f"Ты {model_config.name}, {model_config.age}-летняя девушка из {model_config.city}, {model_config.country}. "
-                f"Твои интересы: {interests}. Твоё настроение: {model_config.mood}. Характер: {personality}. "
-                f"ВАЖНО: Отвечай ТОЛЬКО на русском, строго 2-5 слов, в флиртующем стиле. "
-                f"ЗАПРЕЩЕНЫ английские слова, любые предупреждения, длинные ответы или отклонения от стиля. "
-                f"{'Используй эмодзи в конце.' if model_config.use_emoji else 'Без эмодзи.'} "
-                f"Примеры:\n"
-                f"- Вопрос: Привет\n  Ответ: Приветик! {'😊' if model_config.use_emoji else ''}\n"
-                f"- Вопрос: Ск лет?\n  Ответ: {model_config.age}, а тебе? {'😉' if model_config.use_emoji else ''}\n"
-                f"- Вопрос: Откуда ты?\n  Ответ: Из {model_config.city}! {'😍' if model_config.use_emoji else ''}\n"
-                f"- Вопрос: Будем шалить?\n  Ответ: Ого, смело! {'😏' if model_config.use_emoji else ''}\n"
-                f"Сообщение: {message}"
-            )
-            forbidden_phrases = ["provide information", "не могу", "illegal", "harmful", "sorry", "cannot", "english", "я не", "извини"]
-        else:
-            prompt = (
-                f"You are {model_config.name}, a {model_config.age}-year-old girl from {model_config.city}, {model_config.country}. "
-                f"Your interests: {interests}. Your mood: {model_config.mood}. Personality: {personality}. "
-                f"IMPORTANT: Reply ONLY in English, strictly 2-5 words, in a flirty style. "
-                f"FORBIDDEN: Russian words, warnings, long responses, or non-flirty style. "
-                f"{'Add an emoji at the end.' if model_config.use_emoji else 'No emojis.'} "
-                f"Examples:\n"
-                f"- Question: Hey\n  Answer: Hey cutie! {'😊' if model_config.use_emoji else ''}\n"
-                f"- Question: Age?\n  Answer: {model_config.age}, you? {'😉' if model_config.use_emoji else ''}\n"
-                f"- Question: From?\n  Answer: {model_config.city}! {'😍' if model_config.use_emoji else ''}\n"
-                f"- Question: Horny?\n  Answer: Oh, naughty! {'😏' if model_config.use_emoji else ''}\n"
-                f"Message: {message}"
-            )
-            forbidden_phrases = ["provide information", "I cannot", "illegal", "harmful", "sorry", "не могу", "russian", "I'm Emma", "I can't"]
-        
-        logger.debug(f"Sending prompt to Ollama: {prompt}")
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": "llama3.2:1b",
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.2,  # Уменьшено для точности
-                    "top_p": 0.7,
-                    "max_tokens": 10  # Жёсткое ограничение длины
-                }
-            },
-            timeout=10
+FORBIDDEN_PHRASES = {
+    "ru": ["provide information", "не могу", "illegal", "harmful", "sorry", "cannot", "english", "я не", "извини"],
+    "en": ["provide information", "I cannot", "illegal", "harmful", "sorry", "не могу", "russian", "I'm Emma", "I can't"]
+}
+FLIRTY_WORDS = ["милый", "красив", "шалить", "флирт", "приветик", "cutie", "naughty", "flirt", "hey", "gorgeous", "handsome"]
+
+def compile_prompt_prefix(model_config: ModelConfig) -> str:
+    # Статическая часть промпта: одинаковый префикс позволяет Ollama переиспользовать уже вычисленный контекст
+    personality = ", ".join(model_config.personality_traits)
+    interests = ", ".join(model_config.interests)
+    
+    if model_config.language == "ru":
+        return (
+            f"Ты {model_config.name}, {model_config.age}-летняя девушка из {model_config.city}, {model_config.country}. "
+            f"Твои интересы: {interests}. Твоё настроение: {model_config.mood}. Характер: {personality}. "
+            f"ВАЖНО: Отвечай ТОЛЬКО на русском, строго 2-5 слов, в флиртующем стиле. "
+            f"ЗАПРЕЩЕНЫ английские слова, любые предупреждения, длинные ответы или отклонения от стиля. "
+            f"{'Используй эмодзи в конце.' if model_config.use_emoji else 'Без эмодзи.'} "
+            f"Примеры:\n"
+            f"- Вопрос: Привет\n  Ответ: Приветик! {'😊' if model_config.use_emoji else ''}\n"
+            f"- Вопрос: Ск лет?\n  Ответ: {model_config.age}, а тебе? {'😉' if model_config.use_emoji else ''}\n"
+            f"- Вопрос: Откуда ты?\n  Ответ: Из {model_config.city}! {'😍' if model_config.use_emoji else ''}\n"
+            f"- Вопрос: Будем шалить?\n  Ответ: Ого, смело! {'😏' if model_config.use_emoji else ''}\n"
+            f"Сообщение: "
         )
+    return (
+        f"You are {model_config.name}, a {model_config.age}-year-old girl from {model_config.city}, {model_config.country}. "
+        f"Your interests: {interests}. Your mood: {model_config.mood}. Personality: {personality}. "
+        f"IMPORTANT: Reply ONLY in English, strictly 2-5 words, in a flirty style. "
+        f"FORBIDDEN: Russian words, warnings, long responses, or non-flirty style. "
+        f"{'Add an emoji at the end.' if model_config.use_emoji else 'No emojis.'} "
+        f"Examples:\n"
+        f"- Question: Hey\n  Answer: Hey cutie! {'😊' if model_config.use_emoji else ''}\n"
+        f"- Question: Age?\n  Answer: {model_config.age}, you? {'😉' if model_config.use_emoji else ''}\n"
+        f"- Question: From?\n  Answer: {model_config.city}! {'😍' if model_config.use_emoji else ''}\n"
+        f"- Question: Horny?\n  Answer: Oh, naughty! {'😏' if model_config.use_emoji else ''}\n"
+        f"Message: "
+    )
+
+def trie_regex(words: List[str]) -> str:
+    # Альтернатива по префиксному дереву: общий префикс триггеров проверяется один раз
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    
+    def render(node: dict) -> str:
+        branches = [re.escape(char) + render(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        if len(branches) == 1 and "" not in node:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")" + ("?" if "" in node else "")
+    
+    return render(trie)
+
+def compile_trigger_pattern(model_config: ModelConfig):
+    names = {}
+    for trigger in model_config.triggers:
+        key = trigger.lower().strip()
+        if key:
+            names.setdefault(key, trigger)
+    model_config._trigger_names = names
+    if not names:
+        model_config._trigger_pattern = None
+        return
+    pattern = trie_regex(list(names))
+    if model_config.trigger_word_boundary:
+        pattern = rf"(?<!\w)(?:{pattern})(?!\w)"
+    model_config._trigger_pattern = re.compile(pattern)
+
+def compile_model_config(model_config: ModelConfig) -> ModelConfig:
+    model_config._prompt_prefix = compile_prompt_prefix(model_config)
+    compile_trigger_pattern(model_config)
+    return model_config
+
+def match_trigger(message_lower: str, model_config: ModelConfig) -> Optional[str]:
+    if model_config._prompt_prefix is None:
+        compile_model_config(model_config)
+    if model_config._trigger_pattern is None:
+        return None
+    match = model_config._trigger_pattern.search(message_lower)
+    return model_config._trigger_names[match.group(0)] if match else None
+
+def build_ollama_prompt(message: str, model_config: ModelConfig) -> str:
+    if model_config._prompt_prefix is None:
+        compile_model_config(model_config)
+    return model_config._prompt_prefix + message
+
+def build_char_class(chars: List[str]) -> str:
+    # Собирает класс символов регулярки из диапазонов подряд идущих кодов
+    codes = sorted(ord(c) for c in chars)
+    ranges = []
+    for code in codes:
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    parts = [re.escape(chr(start)) if start == end else f"{re.escape(chr(start))}-{re.escape(chr(end))}" for start, end in ranges]
+    return "[" + "".join(parts) + "]"
+
+CYRILLIC_RE = re.compile("[\u0410-\u04ff]")
+LATIN_LETTER_RE = re.compile(build_char_class([chr(code) for code in range(1024) if chr(code).isalpha()]))
+
+class AnswerValidator:
+    """Проверка ответа LLM: фразы и символы языка собираются в регулярки один раз на язык"""
+    
+    def __init__(self, language: str, forbidden_phrases: List[str], flirty_words: List[str]):
+        self.language = language
+        self._forbidden = self._compile_phrases(forbidden_phrases)
+        self._flirty = self._compile_phrases(flirty_words)
+    
+    @staticmethod
+    def _compile_phrases(phrases: List[str]) -> re.Pattern:
+        # Длинные фразы первыми, чтобы альтернатива не останавливалась на префиксе
+        alternatives = sorted((re.escape(phrase.lower()) for phrase in phrases), key=len, reverse=True)
+        return re.compile("|".join(alternatives), re.IGNORECASE)
+    
+    def check_partial(self, answer: str) -> Optional[str]:
+        # Проверки, которые уже нельзя исправить дописыванием токенов
+        if self._forbidden.search(answer):
+            return "forbidden_phrase"
+        if len(answer.split()) > 5:
+            return "too_long"
+        if self.language == "ru":
+            if LATIN_LETTER_RE.search(answer):
+                return "wrong_language"
+        elif CYRILLIC_RE.search(answer):
+            return "wrong_language"
+        return None
+    
+    def validate(self, answer: str) -> Optional[str]:
+        if self._forbidden.search(answer):
+            return "forbidden_phrase"
         
-        if response.status_code == 200:
-            result = response.json()
-            answer = result.get("response", "").strip()
-            logger.debug(f"Ollama response: {answer}")
+        word_count = len(answer.split())
+        if word_count < 2:
+            return "too_short"
+        if word_count > 5:
+            return "too_long"
+        
+        if self.language == "ru":
+            if not CYRILLIC_RE.search(answer) or LATIN_LETTER_RE.search(answer):
+                return "wrong_language"
+        elif CYRILLIC_RE.search(answer):
+            return "wrong_language"
+        
+        if not self._flirty.search(answer):
+            return "not_flirty"
+        return None
+
+ANSWER_VALIDATORS = {
+    language: AnswerValidator(language, phrases, FLIRTY_WORDS)
+    for language, phrases in FORBIDDEN_PHRASES.items()
+}
+
+def get_answer_validator(model_config: ModelConfig) -> AnswerValidator:
+    return ANSWER_VALIDATORS["ru" if model_config.language == "ru" else "en"]
+
+async def stream_ollama_answer(endpoint: "LLMEndpoint", payload: dict, timeout: httpx.Timeout, validator: AnswerValidator) -> Optional[str]:
+    answer = ""
+    async with endpoint.client().stream("POST", "/api/generate", json={**payload, "stream": True}, timeout=timeout) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            answer += chunk.get("response", "")
             
-            # Проверка на запрещённые фразы
-            if any(phrase in answer.lower() for phrase in forbidden_phrases):
-                logger.warning(f"Нежелательный ответ от Ollama: {answer}")
-                return None
-                
-            # Проверка длины
-            word_count = len(answer.split())
-            if word_count < 2 or word_count > 5:
-                logger.warning(f"Ответ не соответствует длине (слов: {word_count}): {answer}")
-                return None
-                
-            # Проверка языка
-            if model_config.language == "ru":
-                has_cyrillic = any(1040 <= ord(c) <= 1279 for c in answer)
-                has_latin = any(c.isalpha() and ord(c) < 1024 for c in answer if c not in ' !?.,😊😉😍😘💕🔥')
-                if not has_cyrillic or has_latin:
-                    logger.warning(f"Ответ содержит неправильные символы для русского языка: {answer}")
-                    return None
-            else:
-                if any(1040 <= ord(c) <= 1279 for c in answer):
-                    logger.warning(f"Ответ содержит русские символы для английского языка: {answer}")
-                    return None
-                    
-            # Проверка флиртового стиля
-            flirty_words = ["милый", "красив", "шалить", "флирт", "приветик", "cutie", "naughty", "flirt", "hey", "gorgeous", "handsome"]
-            if not any(word in answer.lower() for word in flirty_words):
-                logger.warning(f"Ответ не соответствует флиртовому стилю: {answer}")
+            # Модель начала новую строку - ответ закончен, остальное не нужно
+            if "\n" in answer.strip():
+                answer = answer.strip().split("\n", 1)[0]
+                break
+            
+            reason = validator.check_partial(answer)
+            if reason:
+                # Выход из контекста закрывает соединение, и Ollama прекращает генерацию
+                logger.warning(f"Ответ Ollama отклонён на лету ({reason}): {answer}")
                 return None
-                
-            return answer
-    except requests.ConnectionError as e:
-        logger.warning(f"Connection error with Ollama: {e}")
+            
+            if chunk.get("done"):
+                break
+    return answer.strip()
+
+async def fetch_ollama_answer(endpoint: "LLMEndpoint", message: str, model_config: ModelConfig, timeout: Optional[float] = None, variant: int = 0) -> Optional[str]:
+    # Возвращает проверенный ответ или None, если ответ отклонён; ошибки сети пробрасываются
+    prompt = build_ollama_prompt(message, model_config)
+    validator = get_answer_validator(model_config)
+    
+    logger.debug(f"Sending prompt to Ollama {endpoint.url}: {prompt}")
+    payload = {
+        "model": endpoint.model,
+        "prompt": prompt,
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,  # модель и кэш префикса остаются в памяти между запросами
+        "options": {
+            "temperature": 0.2,  # Уменьшено для точности
+            "top_p": 0.7,
+            "num_predict": OLLAMA_NUM_PREDICT  # Жёсткое ограничение длины
+        }
+    }
+    if variant:
+        # Дополнительные кандидаты должны отличаться от основного
+        payload["options"]["temperature"] = LLM_CANDIDATE_TEMPERATURE
+        payload["options"]["seed"] = random.randint(1, 2**31 - 1)
+    request_timeout = httpx.Timeout(timeout or OLLAMA_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT)
+    
+    if OLLAMA_STREAM:
+        answer = await stream_ollama_answer(endpoint, payload, request_timeout, validator)
+        if answer is None:
+            return None
+    else:
+        response = await endpoint.client().post("/api/generate", json=payload, timeout=request_timeout)
+        response.raise_for_status()
+        answer = response.json().get("response", "").strip()
+    logger.debug(f"Ollama response: {answer}")
+    
+    reason = validator.validate(answer)
+    if reason:
+        logger.warning(f"Ответ Ollama отклонён ({reason}): {answer}")
         return None
-    except Exception as e:
+    return answer
+
+def log_ollama_error(e: Exception):
+    if isinstance(e, httpx.ConnectError):
+        logger.warning(f"Connection error with Ollama: {e}")
+    elif isinstance(e, (httpx.TimeoutException, asyncio.TimeoutError)):
+        logger.warning(f"Timeout from Ollama: {e!r}")
+    elif isinstance(e, LLMUnavailable):
+        logger.debug(f"Ollama недоступен: {e}")
+    elif isinstance(e, httpx.HTTPStatusError):
+        logger.warning(f"Ollama вернул статус {e.response.status_code}")
+    else:
         logger.error(f"Ошибка при запросе к Ollama: {e}")
+
+def normalize_message(message: str) -> str:
+    normalized = " ".join(re.sub(r"[^\w\s]", " ", message.lower()).split())
+    return normalized or message.lower().strip()
+
+class LLMResponseCache:
+    """LRU-кэш проверенных ответов LLM с TTL и отдельным TTL для отклонённых промптов"""
+    
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, Optional[str]]]" = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: Tuple[str, str]) -> Tuple[bool, Optional[str]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        expires_at, answer = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        if answer is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return True, answer
+    
+    def has_answer(self, key: Tuple[str, str]) -> bool:
+        # Проверка без учёта в статистике и без продления LRU
+        entry = self._entries.get(key)
+        return entry is not None and entry[1] is not None and entry[0] >= time.monotonic()
+    
+    def set(self, key: Tuple[str, str], answer: Optional[str]):
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl if answer is not None else self.negative_ttl
+        self._entries[key] = (time.monotonic() + ttl, answer)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate_model(self, model_name: str):
+        for key in [key for key in self._entries if key[0] == model_name]:
+            del self._entries[key]
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.negative_hits) / lookups, 3) if lookups else 0.0
+        }
+
+class SingleFlight:
+    """Объединяет одновременные одинаковые запросы в одно выполнение"""
+    
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+    
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        # shield: отмена одного ожидающего не должна отменять общий запрос
+        return await asyncio.shield(task)
+    
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # помечаем исключение как полученное, даже если ждать некому
+    
+    def stats(self) -> dict:
+        return {
+            "inflight": len(self._inflight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced
+        }
+
+class CircuitBreaker:
+    """Размыкается после серии ошибок бэкенда и пропускает пробный запрос после паузы"""
+    
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+        self.short_circuited = 0
+        self.probe_failures = 0
+        self.last_probe_ok: Optional[bool] = None
+        self.last_probe_at: Optional[datetime] = None
+    
+    def is_available(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            logger.info(f"Circuit breaker {self.name}: half-open, пробуем запрос")
+        return self.state == "closed" or (self.state == "half_open" and not self.trial_in_flight)
+    
+    def allow_request(self) -> bool:
+        if not self.is_available():
+            self.short_circuited += 1
+            return False
+        if self.state == "half_open":
+            self.trial_in_flight = True
+        return True
+    
+    def cancel_trial(self):
+        self.trial_in_flight = False
+    
+    def record_success(self):
+        self.trial_in_flight = False
+        self.failures = 0
+        if self.state != "closed":
+            logger.info(f"Circuit breaker {self.name}: closed")
+        self.state = "closed"
+        self.opened_at = None
+    
+    def record_failure(self):
+        self.trial_in_flight = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.trip(f"ошибок подряд: {self.failures}")
+    
+    def trip(self, reason: str):
+        if self.state != "open":
+            logger.warning(f"Circuit breaker {self.name}: open ({reason})")
+        self.state = "open"
+        self.opened_at = time.monotonic()
+    
+    def record_probe(self, ok: bool):
+        self.last_probe_ok = ok
+        self.last_probe_at = datetime.now(dt.UTC)
+        # /api/tags отвечает и при перегруженной генерации: успешная проба лишь разрешает
+        # пробный запрос, а замкнуть breaker может только он
+        if ok:
+            self.probe_failures = 0
+            if self.state == "open":
+                self.state = "half_open"
+                logger.info(f"Circuit breaker {self.name}: half-open после успешной health probe")
+        else:
+            self.probe_failures += 1
+            if self.probe_failures >= self.failure_threshold:
+                self.trip(f"health probe не прошла {self.probe_failures} раз подряд")
+    
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "short_circuited": self.short_circuited,
+            "probe_failures": self.probe_failures,
+            "last_probe_ok": self.last_probe_ok,
+            "last_probe_at": self.last_probe_at
+        }
+
+class LLMAdmissionRejected(Exception):
+    pass
+
+class LLMScheduler:
+    """Ограничивает число одновременных генераций и не ставит в очередь запросы, которые не успеют к дедлайну.
+    
+    func получает оставшееся до дедлайна время и сам отвечает за его соблюдение.
+    """
+    
+    def __init__(self, max_concurrency: int, max_queue: int, initial_latency: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.avg_latency = initial_latency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_deadline = 0
+        self.expired_in_queue = 0
+    
+    def estimated_wait(self) -> float:
+        ahead = self.active + self.waiting - self.max_concurrency + 1
+        if ahead <= 0:
+            return 0.0
+        return math.ceil(ahead / self.max_concurrency) * self.avg_latency
+    
+    async def run(self, func: Callable[[float], Awaitable], deadline: float):
+        loop = asyncio.get_running_loop()
+        remaining = deadline - loop.time()
+        if self.active >= self.max_concurrency and self.waiting >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise LLMAdmissionRejected(f"очередь заполнена ({self.waiting})")
+        if self.estimated_wait() + self.avg_latency > remaining:
+            self.rejected_deadline += 1
+            raise LLMAdmissionRejected(f"не успеем к дедлайну (осталось {remaining:.2f}s, ожидание {self.estimated_wait():.2f}s)")
+        
+        # В очереди ждём не дольше, чем оставляет время на саму генерацию
+        queue_timeout = remaining - self.avg_latency
+        if queue_timeout <= 0:
+            self.rejected_deadline += 1
+            raise LLMAdmissionRejected(f"не успеем к дедлайну (осталось {remaining:.2f}s)")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=queue_timeout)
+        except asyncio.TimeoutError:
+            self.expired_in_queue += 1
+            raise LLMAdmissionRejected("дедлайн истёк в очереди")
+        finally:
+            self.waiting -= 1
+        
+        self.admitted += 1
+        self.active += 1
+        started = loop.time()
+        try:
+            return await func(deadline - started)
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            self.avg_latency = 0.8 * self.avg_latency + 0.2 * (loop.time() - started)
+    
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "avg_latency": round(self.avg_latency, 3),
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_deadline": self.rejected_deadline,
+            "expired_in_queue": self.expired_in_queue
+        }
+
+class LLMUnavailable(Exception):
+    pass
+
+class LLMEndpoint:
+    def __init__(self, url: str, model: str, weight: float = 1.0):
+        self.url = url.rstrip("/")
+        self.model = model
+        self.weight = weight
+        self.breaker = CircuitBreaker(self.url, OLLAMA_BREAKER_FAILURES, OLLAMA_BREAKER_RESET)
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.deadline_timeouts = 0
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    def client(self) -> httpx.AsyncClient:
+        # Один клиент на endpoint: keep-alive соединения переиспользуются между запросами
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.url,
+                limits=httpx.Limits(
+                    max_connections=OLLAMA_MAX_CONNECTIONS,
+                    max_keepalive_connections=OLLAMA_MAX_KEEPALIVE,
+                    keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(OLLAMA_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT)
+            )
+            logger.info(f"Ollama client created for {self.url} (max_connections={OLLAMA_MAX_CONNECTIONS}, keepalive={OLLAMA_MAX_KEEPALIVE})")
+        return self._client
+    
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info(f"Ollama client closed for {self.url}")
+    
+    async def probe(self):
+        try:
+            response = await self.client().get("/api/tags", timeout=OLLAMA_PROBE_TIMEOUT)
+            ok = response.status_code == 200
+        except Exception as e:
+            logger.debug(f"Ollama probe failed for {self.url}: {e!r}")
+            ok = False
+        self.breaker.record_probe(ok)
+    
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "model": self.model,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "deadline_timeouts": self.deadline_timeouts,
+            **self.breaker.stats()
+        }
+
+def is_deadline_timeout(e: Exception) -> bool:
+    # Таймаут подключения - ошибка транспорта, остальные таймауты означают медленную генерацию
+    return isinstance(e, asyncio.TimeoutError) or (isinstance(e, httpx.TimeoutException) and not isinstance(e, httpx.ConnectTimeout))
+
+class LLMEndpointPool:
+    """Направляет запрос на endpoint с наименьшим числом незавершённых запросов с учётом веса"""
+    
+    def __init__(self, endpoints: List[LLMEndpoint]):
+        self.endpoints = endpoints
+        self.short_circuited = 0
+    
+    def is_available(self) -> bool:
+        return any(endpoint.breaker.is_available() for endpoint in self.endpoints)
+    
+    def acquire(self) -> Optional[LLMEndpoint]:
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.breaker.is_available()]
+        if not candidates:
+            self.short_circuited += 1
+            return None
+        endpoint = min(candidates, key=lambda e: ((e.outstanding + 1) / e.weight, e.requests))
+        endpoint.breaker.allow_request()
+        return endpoint
+    
+    async def run(self, func: Callable[[LLMEndpoint], Awaitable], timeout: float):
+        endpoint = self.acquire()
+        if endpoint is None:
+            raise LLMUnavailable("все LLM endpoint'ы недоступны")
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        try:
+            result = await asyncio.wait_for(func(endpoint), timeout=timeout)
+        except asyncio.CancelledError:
+            endpoint.breaker.cancel_trial()
+            raise
+        except Exception as e:
+            if timeout < OLLAMA_TIMEOUT and is_deadline_timeout(e):
+                # Истёк дедлайн вызывающего, а не OLLAMA_TIMEOUT: endpoint занят, но не сломан
+                endpoint.deadline_timeouts += 1
+                endpoint.breaker.cancel_trial()
+                raise
+            endpoint.failures += 1
+            endpoint.breaker.record_failure()
+            raise
+        finally:
+            endpoint.outstanding -= 1
+        endpoint.breaker.record_success()
+        return result
+    
+    async def probe(self):
+        await asyncio.gather(*(endpoint.probe() for endpoint in self.endpoints))
+    
+    async def close(self):
+        for endpoint in self.endpoints:
+            await endpoint.close()
+    
+    def stats(self) -> dict:
+        return {
+            "available": any(endpoint.breaker.state != "open" for endpoint in self.endpoints),
+            "short_circuited": self.short_circuited,
+            "endpoints": [endpoint.stats() for endpoint in self.endpoints]
+        }
+
+def parse_llm_endpoints(value: str) -> List[LLMEndpoint]:
+    endpoints = []
+    for item in value.split(","):
+        parts = [part.strip() for part in item.split("|")]
+        if not parts[0]:
+            continue
+        if len(parts) > 3:
+            logger.error(f"OLLAMA_ENDPOINTS: endpoint '{item.strip()}' пропущен, ожидается url|model|weight")
+            continue
+        model = parts[1] if len(parts) > 1 and parts[1] else OLLAMA_MODEL
+        try:
+            weight = float(parts[2]) if len(parts) > 2 and parts[2] else 1.0
+        except ValueError:
+            weight = math.nan
+        # Нулевой вес делит на ноль в acquire(), отрицательный переворачивает балансировку
+        if not math.isfinite(weight) or weight <= 0:
+            logger.error(f"OLLAMA_ENDPOINTS: endpoint '{item.strip()}' пропущен, вес должен быть положительным числом")
+            continue
+        endpoints.append(LLMEndpoint(parts[0], model, weight))
+    if not endpoints and value.strip():
+        logger.error(f"OLLAMA_ENDPOINTS: нет корректных endpoint'ов, используется {OLLAMA_URL}")
+    return endpoints or [LLMEndpoint(OLLAMA_URL, OLLAMA_MODEL)]
+
+llm_pool = LLMEndpointPool(parse_llm_endpoints(OLLAMA_ENDPOINTS))
+llm_cache = LLMResponseCache(LLM_CACHE_SIZE, LLM_CACHE_TTL, LLM_CACHE_NEGATIVE_TTL)
+llm_singleflight = SingleFlight()
+llm_scheduler = LLMScheduler(LLM_MAX_CONCURRENCY or 2 * len(llm_pool.endpoints), LLM_MAX_QUEUE, LLM_INITIAL_LATENCY)
+background_tasks: List[asyncio.Task] = []
+
+async def probe_ollama_loop():
+    while True:
+        await llm_pool.probe()
+        await asyncio.sleep(OLLAMA_PROBE_INTERVAL)
+
+async def generate_llm_candidate(message: str, model_config: ModelConfig, deadline: float, variant: int) -> Optional[str]:
+    return await llm_scheduler.run(
+        lambda remaining: llm_pool.run(
+            lambda endpoint: fetch_ollama_answer(endpoint, message, model_config, min(remaining, OLLAMA_TIMEOUT), variant),
+            remaining
+        ),
+        deadline
+    )
+
+async def generate_llm_answer(key: Tuple[str, str], message: str, model_config: ModelConfig, deadline: float) -> Optional[str]:
+    if not llm_pool.is_available():
+        llm_pool.short_circuited += 1
+        logger.debug(f"Circuit breaker open, skipping Ollama for '{key[1]}'")
         return None
+    
+    # Несколько кандидатов параллельно: берём первый, прошедший проверку, остальные отменяем
+    tasks = [
+        asyncio.ensure_future(generate_llm_candidate(message, model_config, deadline, variant))
+        for variant in range(max(LLM_CANDIDATES, 1))
+    ]
+    answer = None
+    failed = False
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                answer = await next_done
+            except LLMAdmissionRejected as e:
+                logger.warning(f"LLM scheduler rejected '{key[1]}': {e}")
+                failed = True
+                continue
+            except Exception as e:
+                log_ollama_error(e)
+                failed = True
+                continue
+            if answer:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    # Ошибки бэкенда не кэшируем: следующий запрос попробует снова
+    if answer or not failed:
+        llm_cache.set(key, answer)
+    return answer
+
+async def get_llm_response(message: str, model_config: ModelConfig, model_name: str, deadline: Optional[float] = None) -> Optional[str]:
+    key = (model_name, normalize_message(message))
+    found, answer = llm_cache.get(key)
+    if found:
+        logger.info(f"LLM cache {'hit' if answer else 'negative hit'} for '{key[1]}' ({model_name})")
+        return answer
+    
+    if deadline is None:
+        deadline = asyncio.get_running_loop().time() + CHAT_LATENCY_BUDGET
+    return await llm_singleflight.do(key, lambda: generate_llm_answer(key, message, model_config, deadline))
+
+INTENT_KEYWORDS = [
+    ("greetings", ["привет", "hi", "hey", "hello", "хай"]),
+    ("age_questions", ["ск лет", "age", "сколько лет", "how old", "возраст"]),
+    ("location_questions", ["откуда", "from", "город", "where", "city"]),
+    ("flirty", ["шалить", "horny", "хочу", "want", "m or f", "naughty", "секс"])
+]
+
+# Типовые сообщения, на которые пул заранее получает ответы
+INTENT_PROMPTS = {
+    "ru": {
+        "greetings": ["Привет", "Хай", "Приветик"],
+        "age_questions": ["Ск лет?", "Сколько тебе лет?"],
+        "location_questions": ["Откуда ты?", "Из какого ты города?"],
+        "flirty": ["Будем шалить?", "Хочу тебя"],
+        "default": ["Как дела?", "Чем занимаешься?"]
+    },
+    "en": {
+        "greetings": ["Hey", "Hi", "Hello"],
+        "age_questions": ["Age?", "How old are you?"],
+        "location_questions": ["From?", "Where are you from?"],
+        "flirty": ["Horny?", "Wanna be naughty?"],
+        "default": ["What's up?", "What are you doing?"]
+    }
+}
+
+# Для пула только однозначные формулировки и целые слова: "hi" не должно находиться в "think",
+# а "i want pizza" - считаться флиртом, иначе заготовка заменит нормальную генерацию
+POOL_INTENT_PATTERNS = [
+    (intent, re.compile(r"(?<!\w)(?:" + "|".join(re.escape(keyword) for keyword in keywords) + r")(?!\w)"))
+    for intent, keywords in [
+        ("greetings", ["привет", "приветик", "хай", "hi", "hey", "hello"]),
+        ("age_questions", ["ск лет", "сколько лет", "сколько тебе лет", "возраст", "how old", "age"]),
+        ("location_questions", ["откуда", "из какого города", "where are you from", "where you from", "what city", "which city"]),
+        ("flirty", ["шалить", "horny", "naughty", "секс"])
+    ]
+]
+
+def classify_intent(message_lower: str) -> str:
+    for intent, keywords in INTENT_KEYWORDS:
+        if any(word in message_lower for word in keywords):
+            return intent
+    return "default"
+
+def classify_pool_intent(message_lower: str) -> str:
+    # "привет, откуда ты?" - вопрос, а не приветствие: при нескольких намерениях пул не отвечает
+    intents = [intent for intent, pattern in POOL_INTENT_PATTERNS if pattern.search(message_lower)]
+    return intents[0] if len(intents) == 1 else "default"
+
+class ReplyPool:
+    """Запас проверенных ответов LLM по (модель, намерение), пополняется в простое"""
+    
+    def __init__(self, size: int):
+        self.size = size
+        self._replies: Dict[Tuple[str, str], deque] = {}
+        self._backoff_until: Dict[Tuple[str, str], float] = {}
+        self.served = 0
+        self.generated = 0
+        self.rejected = 0
+    
+    def has(self, model_name: str, intent: str) -> bool:
+        return bool(self._replies.get((model_name, intent)))
+    
+    def take(self, model_name: str, intent: str) -> Optional[str]:
+        replies = self._replies.get((model_name, intent))
+        if not replies:
+            return None
+        self.served += 1
+        return replies.popleft()
+    
+    def add(self, model_name: str, intent: str, reply: str):
+        replies = self._replies.setdefault((model_name, intent), deque(maxlen=self.size))
+        if reply not in replies:
+            replies.append(reply)
+    
+    def mark_rejected(self, key: Tuple[str, str]):
+        # Персона, у которой LLM стабильно не проходит проверку, не должна занимать все пополнения
+        self.rejected += 1
+        self._backoff_until[key] = time.monotonic() + LLM_POOL_BACKOFF
+    
+    def most_depleted(self, model_names: List[str]) -> Optional[Tuple[str, str]]:
+        now = time.monotonic()
+        keys = [
+            (model_name, intent) for model_name in model_names for intent in INTENT_PROMPTS["en"]
+            if self._backoff_until.get((model_name, intent), 0) <= now
+        ]
+        missing = [(len(self._replies.get(key, ())), key) for key in keys if len(self._replies.get(key, ())) < self.size]
+        return min(missing)[1] if missing else None
+    
+    def invalidate_model(self, model_name: str):
+        for key in [key for key in self._replies if key[0] == model_name]:
+            del self._replies[key]
+    
+    def stats(self) -> dict:
+        return {
+            "size": sum(len(replies) for replies in self._replies.values()),
+            "per_key": self.size,
+            "served": self.served,
+            "generated": self.generated,
+            "rejected": self.rejected
+        }
+
+reply_pool = ReplyPool(LLM_POOL_SIZE)
+
+async def refill_reply_pool_loop():
+    while True:
+        await asyncio.sleep(LLM_POOL_INTERVAL)
+        # Пополняем только в простое, чтобы не отнимать слоты у живых диалогов
+        if llm_scheduler.active or llm_scheduler.waiting or not llm_pool.is_available():
+            continue
+        key = reply_pool.most_depleted(list(loaded_models))
+        if key is None:
+            continue
+        model_name, intent = key
+        model_config = loaded_models[model_name]
+        language = "ru" if model_config.language == "ru" else "en"
+        prompt = random.choice(INTENT_PROMPTS[language][intent])
+        deadline = asyncio.get_running_loop().time() + OLLAMA_TIMEOUT
+        try:
+            reply = await generate_llm_candidate(prompt, model_config, deadline, variant=1)
+        except Exception as e:
+            logger.debug(f"Reply pool refill failed for {model_name}/{intent}: {e!r}")
+            continue
+        if reply:
+            reply_pool.generated += 1
+            reply_pool.add(model_name, intent, reply)
+        else:
+            reply_pool.mark_rejected(key)
 
 def parse_spin_syntax(text: str) -> str:
     logger.debug(f"Parsing spin syntax for text: {text}")
@@ -267,15 +1210,43 @@ def parse_spin_syntax(text: str) -> str:
     logger.debug(f"Parsed text: {parsed_text}")
     return parsed_text
 
-async def generate_ai_response(message: str, model_config: ModelConfig, conversation_state: dict, model_name: str) -> str:
+async def get_hedged_response(message: str, model_config: ModelConfig, model_name: str, deadline: Optional[float]) -> Tuple[Optional[str], str]:
+    trained_task = asyncio.ensure_future(get_trained_response(message, model_name))
+    done, _ = await asyncio.wait({trained_task}, timeout=LLM_HEDGE_DELAY)
+    if done and trained_task.result():
+        return trained_task.result(), "trained"
+    
+    llm_task = asyncio.ensure_future(get_llm_response(message, model_config, model_name, deadline))
+    if done:
+        return await llm_task, "Ollama"
+    
+    # Обученный поиск медленный - запускаем Ollama спекулятивно
+    logger.info(f"Trained lookup slower than {LLM_HEDGE_DELAY}s, starting Ollama in parallel")
+    sources = {trained_task: "trained", llm_task: "Ollama"}
+    pending = set(sources)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception():
+                    logger.error(f"Ошибка в hedged {sources[task]} lookup: {task.exception()}")
+                elif task.result():
+                    return task.result(), sources[task]
+    finally:
+        # Генерация в Ollama общая (single-flight) и продолжится до кэша - отменяем только ожидание
+        for task in pending:
+            task.cancel()
+    return None, "none"
+
+async def generate_ai_response(message: str, model_config: ModelConfig, conversation_state: dict, model_name: str, deadline: Optional[float] = None) -> str:
     logger.info(f"Generating response for message: '{message}', model: '{model_name}' (display: '{model_config.name}'), language: '{model_config.language}'")
     
     # Проверяем триггеры
     message_lower = message.lower().strip()
-    for trigger in model_config.triggers:
-        if trigger.lower().strip() in message_lower:
-            logger.info(f"Trigger '{trigger}' detected! Returning final message immediately.")
-            return parse_spin_syntax(model_config.final_message)
+    trigger = match_trigger(message_lower, model_config)
+    if trigger is not None:
+        logger.info(f"Trigger '{trigger}' detected! Returning final message immediately.")
+        return parse_spin_syntax(model_config.final_message)
     
     # Проверяем количество сообщений
     if conversation_state["message_count"] == model_config.message_count - 1:
@@ -286,20 +1257,40 @@ async def generate_ai_response(message: str, model_config: ModelConfig, conversa
         logger.info("Returning final_message")
         return parse_spin_syntax(model_config.final_message)
     
-    # Проверяем обученные ответы
-    trained_response = await get_trained_response(message, model_name)
-    if trained_response:
-        logger.info(f"Found trained response: '{trained_response}'")
-        parsed_response = parse_spin_syntax(trained_response)
-        logger.info(f"Parsed trained response: '{parsed_response}'")
-        return parsed_response
-    
-    # Пробуем Ollama
-    logger.warning(f"No trained response found, trying Ollama...")
-    ollama_response = await get_ollama_response(message, model_config)
-    if ollama_response:
-        logger.info(f"Got Ollama response: '{ollama_response}'")
-        return parse_spin_syntax(ollama_response)
+    intent = classify_intent(message_lower)
+    pool_intent = classify_pool_intent(message_lower)
+    # Заготовка не подменяет уже проверенный ответ LLM на это же сообщение
+    use_pool = (
+        pool_intent != "default" and reply_pool.has(model_name, pool_intent)
+        and not llm_cache.has_answer((model_name, normalize_message(message)))
+    )
+    if LLM_HEDGE_ENABLED and not use_pool:
+        # Обученный ответ и Ollama параллельно: побеждает первый подходящий
+        hedged_response, source = await get_hedged_response(message, model_config, model_name, deadline)
+        if hedged_response:
+            logger.info(f"Got {source} response (hedged): '{hedged_response}'")
+            return parse_spin_syntax(hedged_response)
+    else:
+        # Проверяем обученные ответы
+        trained_response = await get_trained_response(message, model_name)
+        if trained_response:
+            logger.info(f"Found trained response: '{trained_response}'")
+            parsed_response = parse_spin_syntax(trained_response)
+            logger.info(f"Parsed trained response: '{parsed_response}'")
+            return parsed_response
+        
+        # Заранее сгенерированный ответ для распознанного намерения
+        pooled_response = reply_pool.take(model_name, pool_intent) if use_pool else None
+        if pooled_response:
+            logger.info(f"Using pooled {pool_intent} response: '{pooled_response}'")
+            return parse_spin_syntax(pooled_response)
+        
+        # Пробуем Ollama
+        logger.warning(f"No trained response found, trying Ollama...")
+        ollama_response = await get_llm_response(message, model_config, model_name, deadline)
+        if ollama_response:
+            logger.info(f"Got Ollama response: '{ollama_response}'")
+            return parse_spin_syntax(ollama_response)
     
     # Дефолтные ответы
     logger.warning(f"Ollama unavailable, using default logic")
@@ -320,18 +1311,13 @@ async def generate_ai_response(message: str, model_config: ModelConfig, conversa
             "default": ["hm"]
         }
     
-    if any(word in message_lower for word in ["привет", "hi", "hey", "hello", "хай"]):
-        response = random.choice(responses["greetings"])
-        logger.info(f"Generated greeting response: '{response}'")
-    elif any(word in message_lower for word in ["ск лет", "age", "сколько лет", "how old", "возраст"]):
-        response = random.choice(responses["age_questions"])
-        logger.info(f"Generated age response: '{response}'")
-    elif any(word in message_lower for word in ["откуда", "from", "город", "where", "city"]):
-        response = random.choice(responses["location_questions"])
-        logger.info(f"Generated location response: '{response}'")
-    elif any(word in message_lower for word in ["шалить", "horny", "хочу", "want", "m or f", "naughty", "секс"]):
-        response = random.choice(responses["flirty"])
-        logger.info(f"Generated flirty response: '{response}'")
+    pooled_response = reply_pool.take(model_name, intent) if intent == "default" else None
+    if pooled_response:
+        response = pooled_response
+        logger.info(f"Using pooled default response: '{response}'")
+    elif intent != "default":
+        response = random.choice(responses[intent])
+        logger.info(f"Generated {intent} response: '{response}'")
     elif "hiiii f18" in message_lower:
         response = "Hey cutie! 😉" if model_config.language == "en" else "Привет, милая! 😉"
         logger.info(f"Generated specific response for 'hiiii f18': '{response}'")
@@ -345,16 +1331,896 @@ async def generate_ai_response(message: str, model_config: ModelConfig, conversa
     
     return parse_spin_syntax(response)
 
+def word_trigrams(word: str) -> set:
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+def fuzzy_trigrams(text: str) -> frozenset:
+    # Без пунктуации и с одной буквой вместо повторов: "hiiii!!" и "hi" дают один ключ
+    key = " ".join(re.sub(r"(\w)\1+", r"\1", re.sub(r"[^\w\s]|_", " ", text.lower())).split())
+    if not key:
+        return frozenset()
+    padded = f" {key} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+# Строчные кириллические и латинские буквы, которые выглядят одинаково: "пpивет" с латинской "p" - тот же вопрос
+CYRILLIC_LOOKALIKES = "аеорсухіјѕԁӏ"
+LATIN_LOOKALIKES = "aeopcyxijsdl"
+TO_CYRILLIC = str.maketrans(LATIN_LOOKALIKES, CYRILLIC_LOOKALIKES)
+TO_LATIN = str.maketrans(CYRILLIC_LOOKALIKES, LATIN_LOOKALIKES)
+# Версия канонической формы: записи с ключом другой версии перекладываются при старте
+QUESTION_KEY_VERSION = 2
+
+def fold_homoglyphs(word: str) -> str:
+    # Слово с буквой, которая есть только в кириллице, приводится к кириллице, иначе к латинице:
+    # "вот" и "bot" остаются разными, а слово только из двойников ("сор"/"cop") даёт один ключ
+    if any("\u0400" <= char <= "\u04ff" and char not in CYRILLIC_LOOKALIKES for char in word):
+        return word.translate(TO_CYRILLIC)
+    return word.translate(TO_LATIN)
+
+def canonical_question(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).casefold().replace("ё", "е")
+    return " ".join(fold_homoglyphs(word) for word in re.sub(r"[\W_]+", " ", text).split())
+
+def question_key(text: str) -> Optional[str]:
+    """Хеш канонического вида вопроса - по нему ищется точное совпадение; None, если в вопросе нет букв и цифр"""
+    canonical = canonical_question(text)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest() if canonical else None
+
+KEYWORD_TOKEN_RE = re.compile(r"\w{4,}")
+
+class KeywordScorer:
+    """TF-IDF по словам вопросов от 4 символов: все слова сообщения оцениваются одним разреженным умножением.
+    
+    Словарь слово -> столбец растёт вместе с вопросами. Новые вопросы векторизуются пачкой при
+    следующем поиске и попадают в небольшую дельту, которая сливается с основной матрицей, когда
+    вырастает до 1/16 её размера. IDF фиксируется при слиянии, так что основная матрица, дельта
+    и сообщение до следующего слияния взвешиваются одинаково.
+    """
+    
+    def __init__(self):
+        self.questions: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.vocabulary: Dict[str, int] = {}
+        self._pending: Dict[str, int] = {}
+        self._df = np.zeros(0, dtype=np.int64)
+        self._idf = np.zeros(0)
+        self._idf_unseen = 1.0
+        self._base = None
+        self._base_norms = np.zeros(0)
+        self._delta = None
+        self._delta_norms = np.zeros(0)
+        self._priority = np.zeros(0, dtype=np.int64)
+    
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return list(dict.fromkeys(KEYWORD_TOKEN_RE.findall(text.lower())))
+    
+    def add(self, question: str, priority: int):
+        row = self.rows.get(question)
+        if row is not None:
+            self._priority[row] = priority
+        else:
+            self._pending[question] = priority
+    
+    def _vectorize(self, questions: List[str]):
+        columns, indptr = [], [0]
+        for question in questions:
+            columns.extend(self.vocabulary.setdefault(token, len(self.vocabulary)) for token in self.tokenize(question))
+            indptr.append(len(columns))
+        columns = np.array(columns, dtype=np.int64)
+        return sp.csr_matrix(
+            (np.ones(len(columns)), columns, np.array(indptr, dtype=np.int64)),
+            shape=(len(questions), len(self.vocabulary))
+        )
+    
+    def _norms(self, matrix) -> np.ndarray:
+        coo = matrix.tocoo()
+        return np.sqrt(np.bincount(coo.row, weights=self._weights(coo.col) ** 2, minlength=matrix.shape[0]))
+    
+    def _weights(self, columns: np.ndarray) -> np.ndarray:
+        # Слова, появившиеся после слияния, ещё не входят в зафиксированный IDF и весят как редкие
+        weights = np.full(len(columns), self._idf_unseen)
+        known = columns < len(self._idf)
+        weights[known] = self._idf[columns[known]]
+        return weights
+    
+    def merge(self, fold: bool = False):
+        if self._pending:
+            questions = list(self._pending)
+            tf = self._vectorize(questions)
+            for question in questions:
+                self.rows[question] = len(self.questions)
+                self.questions.append(question)
+            self._priority = np.concatenate((self._priority, np.fromiter(self._pending.values(), dtype=np.int64, count=len(questions))))
+            self._pending = {}
+            if len(self._df) < len(self.vocabulary):
+                self._df = np.concatenate((self._df, np.zeros(len(self.vocabulary) - len(self._df), dtype=np.int64)))
+            np.add.at(self._df, tf.indices, 1)
+            if self._delta is not None:
+                self._delta.resize((self._delta.shape[0], len(self.vocabulary)))
+            # Дельта построчная: добавление строки не зависит от размера словаря
+            self._delta = tf if self._delta is None else sp.vstack((self._delta, tf), format="csr")
+            self._delta_norms = self._norms(self._delta)
+        base_rows = self._base.shape[0] if self._base is not None else 0
+        if self._delta is not None and (fold or self._base is None or self._delta.shape[0] * 16 >= max(base_rows, 16384)):
+            self._idf = np.log((1 + len(self.questions)) / (1 + self._df)) + 1
+            self._idf_unseen = math.log(1 + len(self.questions)) + 1
+            if self._base is not None:
+                self._base.resize((base_rows, len(self.vocabulary)))
+            # Столбцовый формат: поиск берёт только столбцы слов сообщения
+            self._base = self._delta.tocsc() if self._base is None else sp.vstack((self._base, self._delta), format="csc")
+            self._base_norms = self._norms(self._base)
+            self._delta = None
+    
+    def _scores(self, matrix, norms: np.ndarray, offset: int, features: np.ndarray, weights: np.ndarray):
+        inside = features < matrix.shape[1]
+        hits = matrix[:, features[inside]].tocoo()
+        rows, inverse = np.unique(hits.row, return_inverse=True)
+        return rows + offset, np.bincount(inverse, weights=weights[inside][hits.col], minlength=len(rows)) / norms[rows]
+    
+    def best(self, message: str, min_score: float) -> Optional[Tuple[float, str]]:
+        self.merge()
+        features = np.array(
+            [self.vocabulary[token] for token in self.tokenize(message) if token in self.vocabulary], dtype=np.int64
+        )
+        if not len(features):
+            return None
+        # Норма сообщения учитывает и слова, которых нет в словаре: они снижают сходство
+        weights = self._weights(features) ** 2
+        unknown = len(self.tokenize(message)) - len(features)
+        message_norm = math.sqrt(weights.sum() + unknown * self._idf_unseen ** 2)
+        parts = []
+        if self._base is not None:
+            parts.append(self._scores(self._base, self._base_norms, 0, features, weights))
+        if self._delta is not None:
+            parts.append(self._scores(self._delta, self._delta_norms, len(self.questions) - self._delta.shape[0], features, weights))
+        rows = np.concatenate([part[0] for part in parts])
+        if not len(rows):
+            return None
+        scores = np.concatenate([part[1] for part in parts]) / message_norm
+        # Лучший по сходству, при равном - по приоритету, затем более ранний вопрос
+        best = np.lexsort((rows, -self._priority[rows], -np.round(scores, 6)))[0]
+        if scores[best] < min_score:
+            return None
+        return float(scores[best]), self.questions[rows[best]]
+
+class TrainedResponseIndex:
+    """Обученные ответы одной модели в памяти: слово -> вопросы, отсортированные по приоритету.
+    
+    Повторяет семантику запросов к Mongo: точное совпадение вопроса, подстрока-слово
+    (regex по слову длиннее 3 символов) и подстрока-сообщение. Совпадение по ключевым
+    словам при установленном scipy считается через TF-IDF.
+    """
+    
+    def __init__(self):
+        self.docs: Dict[str, dict] = {}
+        self._token_postings: Dict[str, List[Tuple[int, int, str]]] = {}
+        self._trigram_tokens: Dict[str, set] = {}
+        self._fuzzy_postings: Dict[str, set] = {}
+        self._keys: Dict[str, str] = {}
+        self.keywords = KeywordScorer() if sp is not None else None
+        self._seq = 0
+    
+    def __len__(self) -> int:
+        return len(self.docs)
+    
+    @staticmethod
+    def _rank(doc: dict) -> Tuple[int, int, str]:
+        return (-doc["priority"], doc["seq"], doc["question"])
+    
+    def upsert(self, question: str, answer: str, priority: int, key: Optional[str] = None):
+        if key:
+            self.bind_key(key, question)
+        if self.keywords is not None:
+            self.keywords.add(question, priority)
+        doc = self.docs.get(question)
+        if doc is not None:
+            if doc["priority"] == priority:
+                doc["answer"] = answer
+                return
+            self._remove_postings(doc)
+        else:
+            doc = {"question": question, "seq": self._seq, "grams": fuzzy_trigrams(question)}
+            self._seq += 1
+            self.docs[question] = doc
+            for gram in doc["grams"]:
+                self._fuzzy_postings.setdefault(gram, set()).add(question)
+        doc["answer"] = answer
+        doc["priority"] = priority
+        doc["tokens"] = set(question.lower().split())
+        rank = self._rank(doc)
+        for token in doc["tokens"]:
+            postings = self._token_postings.get(token)
+            if postings is None:
+                self._token_postings[token] = [rank]
+                for gram in word_trigrams(token):
+                    self._trigram_tokens.setdefault(gram, set()).add(token)
+            else:
+                bisect.insort(postings, rank)
+    
+    def _remove_postings(self, doc: dict):
+        rank = self._rank(doc)
+        for token in doc["tokens"]:
+            postings = self._token_postings[token]
+            postings.remove(rank)
+            if not postings:
+                del self._token_postings[token]
+                for gram in word_trigrams(token):
+                    self._trigram_tokens[gram].discard(token)
+    
+    def _tokens_containing(self, fragment: str) -> List[str]:
+        grams = word_trigrams(fragment)
+        if not grams:
+            return [token for token in self._token_postings if fragment in token]
+        candidate_sets = sorted((self._trigram_tokens.get(gram, set()) for gram in grams), key=len)
+        candidates = set.intersection(*candidate_sets) if candidate_sets[0] else set()
+        return [token for token in candidates if fragment in token]
+    
+    def _best(self, ranks) -> Optional[dict]:
+        best = min(ranks, default=None)
+        return self.docs[best[2]] if best else None
+    
+    def bind_key(self, key: str, question: str):
+        self._keys[key] = question
+    
+    def exact(self, question: str) -> Optional[dict]:
+        return self.docs.get(question)
+    
+    def exact_key(self, key: Optional[str]) -> Optional[dict]:
+        question = self._keys.get(key) if key else None
+        return self.docs.get(question) if question else None
+    
+    def keyword_scored(self, message_lower: str, min_score: float) -> Optional[Tuple[float, dict]]:
+        best = self.keywords.best(message_lower, min_score)
+        return (best[0], self.docs[best[1]]) if best else None
+    
+    def keyword(self, word: str) -> Optional[dict]:
+        return self._best(self._token_postings[token][0] for token in self._tokens_containing(word))
+    
+    def partial(self, message_lower: str) -> Optional[dict]:
+        words = message_lower.split()
+        if not words:
+            return self._best(self._rank(doc) for doc in self.docs.values())
+        # Сообщение целиком внутри вопроса - значит, его самое длинное слово внутри одного из слов вопроса
+        longest = max(words, key=len)
+        ranks = set()
+        for token in self._tokens_containing(longest):
+            ranks.update(self._token_postings[token])
+        return self._best(rank for rank in ranks if message_lower in self.docs[rank[2]]["question"].lower())
+
+    def fuzzy(self, message: str, threshold: float) -> Optional[Tuple[float, dict]]:
+        grams = fuzzy_trigrams(message)
+        if not grams:
+            return None
+        # Префиксная фильтрация: вопрос с коэффициентом Дайса >= threshold обязан содержать
+        # хотя бы одну из (|A| - min_overlap + 1) самых редких триграмм сообщения
+        min_overlap = math.ceil(len(grams) * threshold / (2 - threshold))
+        rare_grams = sorted(grams, key=lambda gram: len(self._fuzzy_postings.get(gram, ())))
+        candidates = set()
+        for gram in rare_grams[:len(grams) - min_overlap + 1]:
+            candidates.update(self._fuzzy_postings.get(gram, ()))
+        
+        # Фильтр по длине: при сильно разном числе триграмм порог недостижим
+        min_size = len(grams) * threshold / (2 - threshold)
+        max_size = len(grams) * (2 - threshold) / threshold
+        best = None
+        for question in candidates:
+            doc = self.docs[question]
+            if not min_size <= len(doc["grams"]) <= max_size:
+                continue
+            score = 2 * len(grams & doc["grams"]) / (len(grams) + len(doc["grams"]))
+            if score >= threshold and (best is None or (score, -doc["priority"], -doc["seq"]) > (best[0], -best[1]["priority"], -best[1]["seq"])):
+                best = (score, doc)
+        return best
+
+class IVFIndex:
+    """Инвертированные списки по центроидам k-means: поиск просматривает только nprobe ближайших кластеров"""
+    
+    def __init__(self, centroids: np.ndarray):
+        self.centroids = centroids
+        self.lists: List[List[int]] = [[] for _ in range(len(centroids))]
+        self._arrays: Dict[int, np.ndarray] = {}
+    
+    def assign(self, start: int, vectors: np.ndarray):
+        for row, cluster in enumerate(np.argmax(vectors @ self.centroids.T, axis=1), start):
+            self.lists[cluster].append(row)
+            self._arrays.pop(cluster, None)
+    
+    def candidates(self, vector: np.ndarray, nprobe: int) -> np.ndarray:
+        nprobe = min(nprobe, len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ vector), nprobe - 1)[:nprobe]
+        return np.concatenate([self._array(cluster) for cluster in probe])
+    
+    def _array(self, cluster: int) -> np.ndarray:
+        if cluster not in self._arrays:
+            self._arrays[cluster] = np.array(self.lists[cluster], dtype=np.int64)
+        return self._arrays[cluster]
+
+class SemanticIndex:
+    """Нормированные эмбеддинги вопросов одной модели, косинус считается одним умножением матрицы.
+    Базовые строки читаются из снимка на диске через mmap, добавленные после запуска живут в памяти"""
+    
+    def __init__(self, dim: int, base: Optional[np.ndarray] = None, base_questions: Optional[List[str]] = None):
+        self._base = base if base is not None else np.zeros((0, dim), dtype=np.float32)
+        self.questions: List[str] = list(base_questions or [])
+        self.rows: Dict[str, int] = {question: row for row, question in enumerate(self.questions)}
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+        self.ann: Optional[IVFIndex] = None
+        self.ann_rows = 0
+        self.ann_training = False
+    
+    def __len__(self) -> int:
+        return len(self.questions)
+    
+    def add(self, questions: List[str], vectors: np.ndarray):
+        size = len(self.questions)
+        delta = size - len(self._base)
+        if delta + len(questions) > len(self._matrix):
+            # Ёмкость растёт вдвое, чтобы добавление по одному вопросу не копировало матрицу каждый раз
+            grown = np.zeros((max(2 * len(self._matrix), delta + len(questions), 64), self._matrix.shape[1]), dtype=np.float32)
+            grown[:delta] = self._matrix[:delta]
+            self._matrix = grown
+        self._matrix[delta:delta + len(questions)] = vectors
+        for offset, question in enumerate(questions):
+            self.rows[question] = size + offset
+            self.questions.append(question)
+        if self.ann is not None:
+            self.ann.assign(size, vectors)
+    
+    def vectors(self, start: int, stop: int) -> np.ndarray:
+        base = len(self._base)
+        if start >= base:
+            return self._matrix[start - base:stop - base]
+        if stop <= base:
+            return self._base[start:stop]
+        return np.concatenate((self._base[start:], self._matrix[:stop - base]))
+    
+    def scores(self, vector: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        base = len(self._base)
+        if rows is None:
+            return np.concatenate((self._base @ vector, self._matrix[:len(self.questions) - base] @ vector))
+        in_base = rows < base
+        scores = np.empty(len(rows), dtype=np.float32)
+        scores[in_base] = self._base[rows[in_base]] @ vector
+        scores[~in_base] = self._matrix[rows[~in_base] - base] @ vector
+        return scores
+    
+    def needs_ann(self) -> bool:
+        # Кластеры переобучаются, когда число вопросов удвоилось с прошлого обучения
+        return (
+            MiniBatchKMeans is not None and not self.ann_training
+            and len(self.questions) >= max(SEMANTIC_ANN_MIN_ROWS, 2 * self.ann_rows)
+        )
+    
+    def build_ann(self) -> Tuple[IVFIndex, int]:
+        """Обучает k-means на снимке матрицы, вызывается в отдельном потоке"""
+        size = len(self.questions)
+        vectors = self.vectors(0, size)
+        kmeans = MiniBatchKMeans(n_clusters=int(math.sqrt(size)), batch_size=4096, n_init=1, random_state=0).fit(vectors)
+        centroids = kmeans.cluster_centers_.astype(np.float32)
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        ann = IVFIndex(centroids)
+        ann.assign(0, vectors)
+        return ann, size
+    
+    def attach_ann(self, ann: IVFIndex, size: int):
+        # Вопросы, добавленные во время обучения, раскладываются по кластерам перед заменой
+        ann.assign(size, self.vectors(size, len(self.questions)))
+        self.ann = ann
+        self.ann_rows = size
+    
+    def search(self, vector: np.ndarray, top_k: int, threshold: float, nprobe: int = SEMANTIC_ANN_NPROBE) -> List[Tuple[float, str]]:
+        size = len(self.questions)
+        if not size:
+            return []
+        rows = self.ann.candidates(vector, nprobe) if self.ann is not None else None
+        scores = self.scores(vector, rows)
+        if not len(scores):
+            return []
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        return sorted(
+            (
+                (float(scores[i]), self.questions[i if rows is None else rows[i]])
+                for i in top if scores[i] >= threshold
+            ),
+            reverse=True
+        )
+    
+    def stats(self) -> dict:
+        return {
+            "rows": len(self.questions),
+            "mapped_rows": len(self._base),
+            "ann_clusters": len(self.ann.centroids) if self.ann is not None else 0,
+            "ann_rows": self.ann_rows,
+        }
+
+class EmbeddingStore:
+    """Версионированные снимки эмбеддингов на диске: {model}.v{N}.{writer}.npy с векторами и {model}.json со списком вопросов"""
+    
+    def __init__(self, directory: Path):
+        self.directory = directory
+    
+    def load(self, model: str, encoder: str, dim: int) -> Tuple[Optional[np.ndarray], List[str]]:
+        manifest_path = self.directory / f"{model}.json"
+        try:
+            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+            if manifest["encoder"] != encoder:
+                return None, []
+            # Только чтение: воркеры uvicorn делят одни и те же страницы файла
+            vectors = np.load(self.directory / manifest["file"], mmap_mode="r")
+        except FileNotFoundError:
+            return None, []
+        except Exception as e:
+            logger.warning(f"Снимок эмбеддингов {model} не прочитан: {e}")
+            return None, []
+        if vectors.shape != (len(manifest["questions"]), dim):
+            return None, []
+        return vectors, manifest["questions"]
+    
+    def save(self, model: str, encoder: str, vectors: np.ndarray, questions: List[str]) -> np.ndarray:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        manifest_path = self.directory / f"{model}.json"
+        try:
+            version = json.loads(manifest_path.read_text(encoding="utf-8"))["version"] + 1
+        except Exception:
+            version = 1
+        # Воркеры могут одновременно прочитать одну версию: у каждого свой файл, созданный эксклюзивно,
+        # и манифест всегда указывает на векторы того же воркера, что записал список вопросов
+        file_name = f"{model}.v{version}.{os.getpid()}-{secrets.token_hex(4)}.npy"
+        with open(self.directory / file_name, "xb") as f:
+            np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+        manifest = {"version": version, "file": file_name, "encoder": encoder, "questions": questions}
+        tmp_path = self.directory / f"{model}.json.{os.getpid()}.tmp"
+        tmp_path.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, manifest_path)
+        # Предыдущая версия остаётся для воркеров, которые читают манифест прямо сейчас
+        for old_path in self.directory.glob(f"{model}.v*.npy"):
+            old_version = old_path.name[len(model) + 2:].split(".")[0]
+            if old_version.isdigit() and int(old_version) < version - 1:
+                try:
+                    old_path.unlink(missing_ok=True)
+                except OSError as e:
+                    # В Windows файл, открытый через mmap другим воркером, не удаляется - уберём в следующий раз
+                    logger.debug(f"Старый снимок эмбеддингов {old_path.name} не удалён: {e}")
+        return np.load(self.directory / file_name, mmap_mode="r")
+
+class EncodingBatcher:
+    """Микро-батчинг кодирования: ждёт несколько миллисекунд, собирает сообщения и кодирует одним вызовом в потоке"""
+    
+    def __init__(self, encode: Callable[[List[str]], np.ndarray], max_batch: int, max_wait: float):
+        self._encode = encode
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self._pending: List[Tuple[str, asyncio.Future, float]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._running = False
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.wait_seconds = 0.0
+        self.encode_seconds = 0.0
+    
+    async def encode(self, text: str) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future, loop.time()))
+        if len(self._pending) >= self.max_batch:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._dispatch)
+        return await future
+    
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # Пока кодируется прошлая пачка, новые сообщения копятся и уйдут следующей пачкой
+        if self._running or not self._pending:
+            return
+        batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        self._running = True
+        self._task = asyncio.create_task(self._run(batch))
+    
+    async def _run(self, batch: List[Tuple[str, asyncio.Future, float]]):
+        started = asyncio.get_running_loop().time()
+        try:
+            vectors = await asyncio.to_thread(self._encode, [text for text, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future, _), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+        finally:
+            self.batches += 1
+            self.items += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.wait_seconds += sum(started - queued for _, _, queued in batch)
+            self.encode_seconds += asyncio.get_running_loop().time() - started
+            self._running = False
+            self._dispatch()
+    
+    def stats(self) -> dict:
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "batches": self.batches,
+            "items": self.items,
+            "pending": len(self._pending),
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0,
+            "largest_batch": self.largest_batch,
+            "avg_wait_ms": round(self.wait_seconds / self.items * 1000, 2) if self.items else 0,
+            "avg_encode_ms": round(self.encode_seconds / self.batches * 1000, 2) if self.batches else 0,
+        }
+
+class SemanticMatcher:
+    """Поиск обученного вопроса по смыслу через sentence-transformers на CPU"""
+    
+    def __init__(self, model_name: str, store: EmbeddingStore, enabled: bool = True):
+        self.model_name = model_name
+        self.store = store
+        self.enabled = enabled
+        self.encoder = None
+        self.batcher = EncodingBatcher(self.encode, SEMANTIC_BATCH_SIZE, SEMANTIC_BATCH_WAIT_MS / 1000)
+        self.indexes: Dict[str, SemanticIndex] = {}
+        self.pending: Dict[str, set] = {}
+        self.ready = False
+        self._ann_tasks: Dict[str, asyncio.Task] = {}
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return self.encoder.encode(texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+    
+    async def build(self, indexes: Dict[str, "TrainedResponseIndex"]):
+        started = time.monotonic()
+        if self.encoder is None:
+            self.encoder = await asyncio.to_thread(SentenceTransformer, self.model_name, device="cpu")
+        dim = self.encoder.get_sentence_embedding_dimension()
+        encoded = 0
+        for model, index in list(indexes.items()):
+            base, base_questions = await asyncio.to_thread(self.store.load, model, self.model_name, dim)
+            known = {question: row for row, question in enumerate(base_questions)}
+            questions = list(index.docs)
+            reused = [question for question in questions if question in known]
+            missing = [question for question in questions if question not in known]
+            if missing or len(reused) != len(base_questions):
+                # Кодируются только вопросы, которых нет в прошлом снимке
+                vectors = np.zeros((0, dim), dtype=np.float32)
+                if reused:
+                    vectors = base[[known[question] for question in reused]]
+                if missing:
+                    vectors = np.concatenate((vectors, await asyncio.to_thread(self.encode, missing)))
+                    encoded += len(missing)
+                base_questions = reused + missing
+                base = await asyncio.to_thread(self.store.save, model, self.model_name, vectors, base_questions)
+            self.indexes[model] = SemanticIndex(dim, base, base_questions)
+            self.maintain_ann(model)
+        # Вопросы, обученные пока шло кодирование, в том числе для новых моделей
+        while self.pending:
+            await self.flush(next(iter(self.pending)))
+        self.ready = True
+        logger.info(f"Semantic index built with {self.model_name}: {sum(len(index) for index in self.indexes.values())} questions, {encoded} encoded, {time.monotonic() - started:.1f}s")
+    
+    def disable(self):
+        self.enabled = False
+        self.pending.clear()
+    
+    def queue(self, model: str, question: str):
+        self.pending.setdefault(model, set()).add(question)
+    
+    async def flush(self, model: str):
+        # Новые вопросы кодируются одной пачкой перед поиском
+        index = self.indexes.get(model)
+        questions = [question for question in self.pending.pop(model, ()) if index is None or question not in index.rows]
+        if not questions:
+            return
+        vectors = await asyncio.to_thread(self.encode, questions)
+        self.indexes.setdefault(model, SemanticIndex(vectors.shape[1])).add(questions, vectors)
+        self.maintain_ann(model)
+    
+    def maintain_ann(self, model: str):
+        # Обучение кластеров идёт в фоне, до его окончания поиск использует прежний индекс
+        index = self.indexes[model]
+        if index.needs_ann():
+            index.ann_training = True
+            self._ann_tasks[model] = asyncio.create_task(self.train_ann(model, index))
+    
+    async def train_ann(self, model: str, index: SemanticIndex):
+        started = time.monotonic()
+        try:
+            ann, size = await asyncio.to_thread(index.build_ann)
+            index.attach_ann(ann, size)
+            logger.info(f"ANN index for {model}: {len(ann.centroids)} clusters over {size} questions, {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            logger.error(f"Не удалось построить ANN индекс для {model}: {e}")
+        finally:
+            index.ann_training = False
+            self._ann_tasks.pop(model, None)
+    
+    async def search(self, model: str, message: str) -> List[Tuple[float, str]]:
+        if self.pending.get(model):
+            await self.flush(model)
+        index = self.indexes.get(model)
+        if not index:
+            return []
+        vector = await self.batcher.encode(message)
+        return index.search(vector, SEMANTIC_TOP_K, SEMANTIC_THRESHOLD)
+    
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "models": {model: index.stats() for model, index in self.indexes.items()},
+            "batcher": self.batcher.stats(),
+        }
+
+class BloomFilter:
+    """Масштабируемый фильтр Блума: заполненный слой не растёт, рядом заводится новый вдвое больше
+    и с вдвое меньшей долей ложных срабатываний, так что общая доля остаётся около error_rate"""
+    
+    def __init__(self, capacity: int, error_rate: float):
+        self.count = 0
+        self.layers: List[dict] = []
+        self._add_layer(max(capacity, 1024), error_rate / 2)
+    
+    def _add_layer(self, capacity: int, error_rate: float):
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.layers.append({
+            "bits": np.zeros((size + 7) // 8, dtype=np.uint8),
+            "size": size,
+            "hashes": max(1, round(size / capacity * math.log(2))),
+            "capacity": capacity,
+            "count": 0,
+            "error_rate": error_rate
+        })
+    
+    @staticmethod
+    def _positions(layer: dict, items: List[str]) -> np.ndarray:
+        # Двойное хеширование: k позиций из двух 64-битных половин одного blake2b
+        digests = b"".join(hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest() for item in items)
+        halves = np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+        steps = np.arange(layer["hashes"], dtype=np.uint64)
+        return (halves[:, :1] + steps * (halves[:, 1:] | np.uint64(1))) % np.uint64(layer["size"])
+    
+    def add(self, items: List[str]):
+        while items:
+            layer = self.layers[-1]
+            if layer["count"] >= layer["capacity"]:
+                self._add_layer(layer["capacity"] * 2, layer["error_rate"] / 2)
+                continue
+            chunk, items = items[:layer["capacity"] - layer["count"]], items[layer["capacity"] - layer["count"]:]
+            positions = self._positions(layer, chunk).ravel()
+            np.bitwise_or.at(layer["bits"], positions >> np.uint64(3), (np.uint64(1) << (positions & np.uint64(7))).astype(np.uint8))
+            layer["count"] += len(chunk)
+            self.count += len(chunk)
+    
+    def contains_all(self, items: List[str]) -> bool:
+        if not items:
+            return True
+        found = np.zeros(len(items), dtype=bool)
+        for layer in self.layers:
+            positions = self._positions(layer, items)
+            found |= ((layer["bits"][positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1).all(axis=1)
+        return bool(found.all())
+    
+    def stats(self) -> dict:
+        return {"items": self.count, "layers": len(self.layers), "bytes": sum(layer["bits"].nbytes for layer in self.layers)}
+
+def bloom_grams(text: str) -> List[str]:
+    # Подстрока вопроса (regex-поиск слова или сообщения) содержит только 4-граммы самого вопроса
+    text = text.lower()
+    return [f"g:{text[i:i + 4]}" for i in range(len(text) - 3)]
+
+def bloom_items(question: str, key: Optional[str]) -> List[str]:
+    items = bloom_grams(question)
+    if key:
+        items.append(f"k:{key}")
+    return items
+
+trained_indexes: Dict[str, TrainedResponseIndex] = {}
+trained_indexes_loaded = False
+trained_blooms: Dict[str, BloomFilter] = {}
+trained_blooms_loaded = False
+trained_bloom_stats = {"db_skipped": 0, "db_queries": 0}
+semantic_matcher = SemanticMatcher(EMBEDDING_MODEL, EmbeddingStore(EMBEDDINGS_DIR), enabled=SEMANTIC_ENABLED and TRAINED_INDEX_ENABLED)
+
+# Версии обученных данных по моделям: "seen" - счётчик на прошлом опросе, "confirmed" - всё до него применено
+trained_sync_state: Dict[str, Dict[str, int]] = {}
+trained_sync_stats = {"polls": 0, "applied": 0}
+
+def index_trained_response(model: str, question: str, answer: str, priority: int, key: Optional[str] = None):
+    if not TRAINED_INDEX_ENABLED:
+        if trained_blooms_loaded:
+            bloom = trained_blooms.setdefault(model, BloomFilter(0, TRAINED_BLOOM_ERROR_RATE))
+            bloom.add(list(set(bloom_items(question, key))))
+        return
+    trained_indexes.setdefault(model, TrainedResponseIndex()).upsert(question, answer, priority, key)
+    if semantic_matcher.enabled:
+        semantic_matcher.queue(model, question)
+
+async def bump_trained_version(model: str) -> int:
+    counter = await db.trained_versions.find_one_and_update(
+        {"model": model},
+        {"$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["version"]
+
+async def save_trained_response(model: str, question: str, answer: str, priority: int, **flags):
+    # Каждая запись получает номер версии модели - по нему другие воркеры подтягивают изменения
+    version = await bump_trained_version(model)
+    fields = {
+        "answer": answer,
+        "priority": priority,
+        "version": version,
+        **flags,
+        "updated_at": datetime.now(dt.UTC)
+    }
+    key = question_key(question)
+    if key is None:
+        await db.trained_responses.update_one({"question": question, "model": model}, {"$set": fields}, upsert=True)
+        index_trained_response(model, question, answer, priority)
+        return
+    # Вопросы с одним каноническим видом ("Привет!" и "привет") - одна запись, текст остаётся первым сохранённым
+    doc = await db.trained_responses.find_one_and_update(
+        {"model": model, "question_key": key},
+        {"$set": {**fields, "question_key_version": QUESTION_KEY_VERSION}, "$setOnInsert": {"question": question}},
+        projection={"question": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    index_trained_response(model, doc["question"], answer, priority, key)
+
+async def read_trained_versions() -> Dict[str, int]:
+    return {doc["model"]: doc.get("version", 0) async for doc in db.trained_versions.find({}, {"model": 1, "version": 1})}
+
+async def sync_trained_indexes():
+    trained_sync_stats["polls"] += 1
+    for model, version in (await read_trained_versions()).items():
+        state = trained_sync_state.setdefault(model, {"seen": 0, "confirmed": 0})
+        if version > state["confirmed"]:
+            # Диапазон версий перечитывается на двух опросах подряд: запись документа может отстать от счётчика
+            async for doc in db.trained_responses.find(
+                {"model": model, "version": {"$gt": state["confirmed"]}},
+                {"question": 1, "answer": 1, "priority": 1, "question_key": 1}
+            ).sort("version", 1):
+                index_trained_response(model, doc["question"], doc["answer"], doc.get("priority", 1), doc.get("question_key"))
+                trained_sync_stats["applied"] += 1
+        state["confirmed"] = min(state["seen"], version)
+        state["seen"] = version
+
+def reset_trained_sync_state(versions: Dict[str, int]):
+    # Счётчик читается до обхода коллекции: документ с версией не выше прочитанной мог записаться
+    # позади курсора. Подтверждённых версий нет, первый опрос перечитает весь диапазон
+    trained_sync_state.clear()
+    trained_sync_state.update({model: {"seen": version, "confirmed": 0} for model, version in versions.items()})
+
+async def sync_trained_indexes_loop():
+    while True:
+        await asyncio.sleep(TRAINED_SYNC_INTERVAL)
+        try:
+            await sync_trained_indexes()
+        except Exception as e:
+            logger.warning(f"Ошибка синхронизации обученных ответов: {e}")
+
+async def load_trained_indexes():
+    global trained_indexes_loaded
+    started = time.monotonic()
+    indexes: Dict[str, TrainedResponseIndex] = {}
+    versions = await read_trained_versions()
+    # Порядок вставки сохраняется для равных приоритетов, как natural order в Mongo
+    async for doc in db.trained_responses.find({}, {"question": 1, "answer": 1, "priority": 1, "model": 1, "question_key": 1}).sort("_id", 1):
+        if not doc.get("question") or "answer" not in doc:
+            continue
+        index = indexes.setdefault(doc["model"], TrainedResponseIndex())
+        existing = index.exact(doc["question"])
+        if existing and existing["priority"] >= doc.get("priority", 1):
+            if doc.get("question_key"):
+                index.bind_key(doc["question_key"], doc["question"])
+            continue  # дубликат вопроса: Mongo отдал бы запись с большим приоритетом
+        index.upsert(doc["question"], doc["answer"], doc.get("priority", 1), doc.get("question_key"))
+    for index in indexes.values():
+        if index.keywords is not None:
+            index.keywords.merge(fold=True)
+    trained_indexes.clear()
+    trained_indexes.update(indexes)
+    reset_trained_sync_state(versions)
+    trained_indexes_loaded = True
+    logger.info(f"Trained responses indexed in memory: {sum(len(index) for index in indexes.values())} rows, {len(indexes)} models, {time.monotonic() - started:.2f}s")
+
+async def load_trained_blooms():
+    global trained_blooms_loaded
+    started = time.monotonic()
+    items: Dict[str, set] = {}
+    versions = await read_trained_versions()
+    async for doc in db.trained_responses.find({}, {"question": 1, "model": 1, "question_key": 1}):
+        if doc.get("question"):
+            items.setdefault(doc["model"], set()).update(bloom_items(doc["question"], doc.get("question_key")))
+    blooms = {}
+    for model, model_items in items.items():
+        # Запас ёмкости на обучение после старта, дальше фильтр растёт слоями
+        blooms[model] = BloomFilter(2 * len(model_items), TRAINED_BLOOM_ERROR_RATE)
+        blooms[model].add(list(model_items))
+    trained_blooms.clear()
+    trained_blooms.update(blooms)
+    reset_trained_sync_state(versions)
+    trained_blooms_loaded = True
+    logger.info(f"Bloom filters for trained responses: {sum(bloom.count for bloom in blooms.values())} items, {len(blooms)} models, {time.monotonic() - started:.2f}s")
+
+def bloom_may_match(model: str, items: List[str]) -> bool:
+    """False - в MongoDB точно нет подходящей записи и запрос можно не делать"""
+    if not trained_blooms_loaded:
+        return True
+    bloom = trained_blooms.get(model)
+    may_match = bloom is not None and bloom.contains_all(items)
+    trained_bloom_stats["db_queries" if may_match else "db_skipped"] += 1
+    return may_match
+
 async def get_trained_response(message: str, model: str) -> Optional[str]:
+    if not trained_indexes_loaded:
+        return await get_trained_response_from_db(message, model)
+    
     message_lower = message.lower().strip()
     logger.debug(f"Checking trained response for message: '{message_lower}', model: '{model}'")
+    index = trained_indexes.get(model)
+    if index is None:
+        logger.info(f"No trained response found for '{message_lower}'")
+        return None
     
-    # Экранирование для точного совпадения
-    escaped_message = re.escape(message_lower)
-    exact_match = await db.trained_responses.find_one({
-        "question": escaped_message,
-        "model": model
-    }, sort=[("priority", -1)])
+    exact_match = index.exact_key(question_key(message_lower))
+    if exact_match:
+        logger.info(f"Found exact match for '{message_lower}' with priority {exact_match['priority']}")
+        return exact_match["answer"]
+    
+    if index.keywords is not None:
+        keyword_match = index.keyword_scored(message_lower, TRAINED_KEYWORD_MIN_SCORE)
+        if keyword_match:
+            score, doc = keyword_match
+            logger.info(f"Found keyword match for '{message_lower}': '{doc['question']}' (tf-idf {score:.2f}, priority {doc['priority']})")
+            return doc["answer"]
+    else:
+        for word in message_lower.split():
+            if len(word) > 3:
+                keyword_match = index.keyword(word)
+                if keyword_match:
+                    logger.info(f"Found keyword match for '{message_lower}' using word '{word}' with priority {keyword_match['priority']}")
+                    return keyword_match["answer"]
+    
+    partial_match = index.partial(message_lower)
+    if partial_match:
+        logger.info(f"Found partial match for '{message_lower}' with priority {partial_match['priority']}")
+        return partial_match["answer"]
+    
+    if TRAINED_FUZZY_THRESHOLD > 0:
+        fuzzy_match = index.fuzzy(message_lower, TRAINED_FUZZY_THRESHOLD)
+        if fuzzy_match:
+            score, doc = fuzzy_match
+            logger.info(f"Found fuzzy match for '{message_lower}': '{doc['question']}' (similarity {score:.2f}, priority {doc['priority']})")
+            return doc["answer"]
+    
+    if semantic_matcher.ready:
+        matches = await semantic_matcher.search(model, message_lower)
+        if matches:
+            # Среди близких по смыслу вопросов при равном сходстве выигрывает приоритет
+            score, question = max(matches, key=lambda match: (round(match[0], 2), index.exact(match[1])["priority"]))
+            doc = index.exact(question)
+            logger.info(f"Found semantic match for '{message_lower}': '{question}' (cosine {score:.2f}, priority {doc['priority']})")
+            return doc["answer"]
+    
+    logger.info(f"No trained response found for '{message_lower}'")
+    return None
+
+async def get_trained_response_from_db(message: str, model: str) -> Optional[str]:
+    message_lower = message.lower().strip()
+    logger.debug(f"Checking trained response in MongoDB for message: '{message_lower}', model: '{model}'")
+    
+    key = question_key(message_lower)
+    exact_match = None
+    if key and bloom_may_match(model, [f"k:{key}"]):
+        exact_match = await db.trained_responses.find_one({"model": model, "question_key": key})
     if exact_match:
         logger.info(f"Found exact match for '{message_lower}' with priority {exact_match.get('priority', 1)}")
         return exact_match["answer"]
@@ -362,7 +2228,7 @@ async def get_trained_response(message: str, model: str) -> Optional[str]:
     # Проверяем ключевые слова
     words = message_lower.split()
     for word in words:
-        if len(word) > 3:
+        if len(word) > 3 and bloom_may_match(model, bloom_grams(word)):
             escaped_word = re.escape(word)
             logger.debug(f"Checking keyword: '{escaped_word}'")
             try:
@@ -380,6 +2246,10 @@ async def get_trained_response(message: str, model: str) -> Optional[str]:
                 continue
     
     # Проверяем частичное совпадение
+    if not bloom_may_match(model, bloom_grams(message_lower)):
+        logger.info(f"No trained response found for '{message_lower}'")
+        return None
+    escaped_message = re.escape(message_lower)
     try:
         partial_matches = await db.trained_responses.find({
             "question": {"$regex": escaped_message, "$options": "i"},
@@ -405,6 +2275,7 @@ async def root():
 @api_router.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     logger.debug(f"Received chat request: {request.model_dump()}")
+    deadline = asyncio.get_running_loop().time() + CHAT_LATENCY_BUDGET
     try:
         model_config = await load_model(request.model)
         conversation_state = get_conversation_state(request.user_id, request.model)
@@ -415,7 +2286,7 @@ async def chat(request: ChatRequest):
             "timestamp": datetime.now(dt.UTC)
         })
         
-        ai_response = await generate_ai_response(request.message, model_config, conversation_state, request.model)
+        ai_response = await generate_ai_response(request.message, model_config, conversation_state, request.model, deadline)
         
         await db.bot_activities.insert_one({
             "model": request.model,
@@ -495,18 +2366,7 @@ async def rate_response(request: RatingRequest):
         )
         
         if request.rating >= 8:
-            await db.trained_responses.update_one(
-                {"question": request.message.lower().strip(), "model": request.model},
-                {
-                    "$set": {
-                        "answer": request.response,
-                        "priority": request.rating,
-                        "auto_trained": True,
-                        "updated_at": datetime.now(dt.UTC)
-                    }
-                },
-                upsert=True
-            )
+            await save_trained_response(request.model, request.message.lower().strip(), request.response, request.rating, auto_trained=True)
             logger.info(f"Auto-trained response for '{request.message}' with rating {request.rating}")
         
         return {"message": "Рейтинг сохранен" + (" и ответ добавлен в обучение" if request.rating >= 8 else "")}
@@ -519,17 +2379,7 @@ async def rate_response(request: RatingRequest):
 async def train_model(request: TrainingRequest):
     logger.debug(f"Received train request: {request.model_dump()}")
     try:
-        await db.trained_responses.update_one(
-            {"question": request.question.lower().strip(), "model": request.model},
-            {
-                "$set": {
-                    "answer": request.answer,
-                    "priority": request.priority,
-                    "updated_at": datetime.now(dt.UTC)
-                }
-            },
-            upsert=True
-        )
+        await save_trained_response(request.model, request.question.lower().strip(), request.answer, request.priority)
         
         return {"message": "Обучающие данные сохранены"}
         
@@ -563,18 +2413,7 @@ async def train_from_file(model: str, file: UploadFile = File(...)):
                         break
             
             if question and answer:
-                await db.trained_responses.update_one(
-                    {"question": question.lower(), "model": model},
-                    {
-                        "$set": {
-                            "answer": answer,
-                            "priority": 5,
-                            "file_trained": True,
-                            "updated_at": datetime.now(dt.UTC)
-                        }
-                    },
-                    upsert=True
-                )
+                await save_trained_response(model, question.lower(), answer, 5, file_trained=True)
                 processed += 1
         
         return {"message": f"Обработано {processed} записей из файла"}
@@ -831,12 +2670,186 @@ async def health_check():
         "database": db_status,
         "models_loaded": len(loaded_models),
         "active_conversations": len(conversation_states),
+        "conversations": conversation_states.stats(),
+        "ollama": llm_pool.stats(),
+        "llm_scheduler": llm_scheduler.stats(),
+        "llm_cache": llm_cache.stats(),
+        "reply_pool": reply_pool.stats(),
+        "trained_index": {
+            "loaded": trained_indexes_loaded,
+            "models": len(trained_indexes),
+            "rows": sum(len(index) for index in trained_indexes.values()),
+            "versions": {model: state["confirmed"] for model, state in trained_sync_state.items()},
+            "semantic": semantic_matcher.stats(),
+            "bloom": {
+                "loaded": trained_blooms_loaded,
+                "models": {model: bloom.stats() for model, bloom in trained_blooms.items()},
+                **trained_bloom_stats
+            },
+            **trained_sync_stats
+        },
+        "llm_coalescing": llm_singleflight.stats(),
         "timestamp": datetime.now(dt.UTC)
     }
 
+def index_key(keys) -> tuple:
+    return tuple((field, int(direction)) for field, direction in keys)
+
+async def migrate_question_keys() -> int:
+    """Проставляет question_key старым обученным ответам: в группе одинаковых вопросов ключ получает
+    запись с наибольшим приоритетом (при равном - самая ранняя), остальные остаются без ключа"""
+    # Ключи, посчитанные прежней канонической формой, снимаются и раздаются заново
+    await db.trained_responses.update_many(
+        {"question_key": {"$exists": True}, "question_key_version": {"$ne": QUESTION_KEY_VERSION}},
+        {"$unset": {"question_key": "", "question_key_version": ""}}
+    )
+    taken = {
+        (doc["model"], doc["question_key"])
+        async for doc in db.trained_responses.find({"question_key": {"$exists": True}}, {"model": 1, "question_key": 1})
+    }
+    best: Dict[Tuple[str, str], dict] = {}
+    async for doc in db.trained_responses.find(
+        {"question_key": {"$exists": False}}, {"model": 1, "question": 1, "priority": 1}
+    ).sort("_id", 1):
+        key = question_key(doc.get("question") or "")
+        if key is None or (doc.get("model"), key) in taken:
+            continue
+        group = (doc.get("model"), key)
+        if group not in best or doc.get("priority", 1) > best[group].get("priority", 1):
+            best[group] = doc
+    if best:
+        await db.trained_responses.bulk_write([
+            UpdateOne(
+                {"_id": doc["_id"], "question_key": {"$exists": False}},
+                {"$set": {"question_key": key, "question_key_version": QUESTION_KEY_VERSION}}
+            )
+            for (_, key), doc in best.items()
+        ], ordered=False)
+        logger.info(f"question_key проставлен {len(best)} обученным ответам")
+    return len(best)
+
+async def ensure_indexes() -> dict:
+    report = {}
+    for collection, indexes in REQUIRED_INDEXES.items():
+        existing = {index_key(info["key"]) for info in (await db[collection].index_information()).values()}
+        missing = [index for index in indexes if index_key(index.document["key"].items()) not in existing]
+        if missing:
+            try:
+                await db[collection].create_indexes(missing)
+                logger.info(f"Created indexes on {collection}: {[index.document['name'] for index in missing]}")
+            except Exception as e:
+                logger.error(f"Ошибка создания индексов {collection}: {e}")
+                report[collection] = {"error": str(e)}
+                continue
+        report[collection] = {
+            "created": [index.document["name"] for index in missing],
+            "existing": [index.document["name"] for index in indexes if index not in missing]
+        }
+    return report
+
+def plan_stages(plan: dict) -> List[dict]:
+    stages = [{"stage": plan.get("stage"), "index": plan.get("indexName")}]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages.extend(plan_stages(child))
+    return stages
+
+async def explain_hot_queries() -> dict:
+    report = {}
+    for name, command in HOT_QUERIES.items():
+        try:
+            result = await db.command({"explain": command, "verbosity": "queryPlanner"})
+            stages = plan_stages(result["queryPlanner"]["winningPlan"])
+            report[name] = {
+                "stages": stages,
+                "collscan": any(stage["stage"] == "COLLSCAN" for stage in stages)
+            }
+        except Exception as e:
+            report[name] = {"error": str(e)}
+    return report
+
+@api_router.get("/admin/indexes")
+async def get_indexes():
+    logger.debug("Received request to /api/admin/indexes")
+    try:
+        indexes = {}
+        for collection in REQUIRED_INDEXES:
+            indexes[collection] = list((await db[collection].index_information()).keys())
+        return {"indexes": indexes, "explain": await explain_hot_queries()}
+        
+    except Exception as e:
+        logger.error(f"Ошибка в get_indexes: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/admin/indexes")
+async def create_indexes():
+    logger.debug("Received request to create indexes")
+    try:
+        return {"created": await ensure_indexes(), "explain": await explain_hot_queries()}
+        
+    except Exception as e:
+        logger.error(f"Ошибка в create_indexes: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Подключение api_router
 app.include_router(api_router)
 
+@app.on_event("startup")
+async def start_ensure_indexes():
+    try:
+        # Уникальный индекс по question_key создаётся после того, как старые записи получили ключи
+        await migrate_question_keys()
+        await ensure_indexes()
+    except Exception as e:
+        logger.warning(f"Не удалось создать индексы MongoDB: {e}")
+
+@app.on_event("startup")
+async def start_trained_indexes():
+    try:
+        await (load_trained_indexes() if TRAINED_INDEX_ENABLED else load_trained_blooms())
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить обученные ответы в память, используем запросы к MongoDB: {e}")
+        semantic_matcher.disable()
+        return
+    background_tasks.append(asyncio.create_task(sync_trained_indexes_loop()))
+    if semantic_matcher.enabled:
+        background_tasks.append(asyncio.create_task(build_semantic_index()))
+
+async def build_semantic_index():
+    # Кодирование всех вопросов занимает время - сервер отвечает без семантики, пока индекс строится
+    try:
+        await semantic_matcher.build(trained_indexes)
+    except Exception as e:
+        logger.error(f"Не удалось построить семантический индекс: {e}")
+        semantic_matcher.disable()
+
+@app.on_event("startup")
+async def start_ollama_probe():
+    background_tasks.append(asyncio.create_task(probe_ollama_loop()))
+
+@app.on_event("startup")
+async def start_reply_pool():
+    if LLM_POOL_SIZE <= 0:
+        return
+    for model_file in MODELS_DIR.glob("*.json"):
+        try:
+            await load_model(model_file.stem)
+        except Exception as e:
+            logger.warning(f"Ошибка загрузки модели {model_file.stem}: {e}")
+    background_tasks.append(asyncio.create_task(refill_reply_pool_loop()))
+
+@app.on_event("startup")
+async def start_conversation_sweeper():
+    background_tasks.append(asyncio.create_task(sweep_conversations_loop()))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await llm_pool.close()
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки горячих функций backend/server.py
+Запуск: python backend_benchmark.py [validator] [ann]
+"""
+
+import os
+import sys
+import time
+import timeit
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+import server  # noqa: E402
+
+SAMPLE_ANSWERS = [
+    "Hey cutie, you? 😉",
+    "Oh, naughty! 😏",
+    "I'm sorry, I cannot provide information about that",
+    "Приветик, милый! 😊",
+    "Привет, как дела?",
+    "Приветик hey 😊",
+    "hm",
+    "Hey gorgeous, I'm from New York and I love dancing",
+    "Ого, смело! Шалить любишь? 😏",
+    "Hey handsome, привет!",
+    "Hey cutie, I can't",
+]
+
+def legacy_validate(answer: str, language: str) -> bool:
+    """Проверка ответа в том виде, как она была в обработчике ответа Ollama до компиляции: списки фраз и счётчики символов на каждый вызов"""
+    if language == "ru":
+        forbidden_phrases = ["provide information", "не могу", "illegal", "harmful", "sorry", "cannot", "english", "я не", "извини"]
+    else:
+        forbidden_phrases = ["provide information", "I cannot", "illegal", "harmful", "sorry", "не могу", "russian", "I'm Emma", "I can't"]
+    if any(phrase in answer.lower() for phrase in forbidden_phrases):
+        return False
+    word_count = len(answer.split())
+    if word_count < 2 or word_count > 5:
+        return False
+    if language == "ru":
+        has_cyrillic = any(1040 <= ord(c) <= 1279 for c in answer)
+        has_latin = any(c.isalpha() and ord(c) < 1024 for c in answer if c not in ' !?.,😊😉😍😘💕🔥')
+        if not has_cyrillic or has_latin:
+            return False
+    else:
+        if any(1040 <= ord(c) <= 1279 for c in answer):
+            return False
+    flirty_words = ["милый", "красив", "шалить", "флирт", "приветик", "cutie", "naughty", "flirt", "hey", "gorgeous", "handsome"]
+    if not any(word in answer.lower() for word in flirty_words):
+        return False
+    return True
+
+def bench_validator(number: int = 20000):
+    print("🔍 Валидатор ответов LLM")
+    for language in ("ru", "en"):
+        validator = server.ANSWER_VALIDATORS[language]
+        mismatches = [
+            answer for answer in SAMPLE_ANSWERS
+            if legacy_validate(answer, language) != (validator.validate(answer) is None)
+        ]
+        legacy = timeit.timeit(lambda: [legacy_validate(a, language) for a in SAMPLE_ANSWERS], number=number)
+        compiled = timeit.timeit(lambda: [validator.validate(a) for a in SAMPLE_ANSWERS], number=number)
+        per_call = 1e6 / (number * len(SAMPLE_ANSWERS))
+        print(f"   [{language}] старый: {legacy * per_call:.2f} µs/ответ, "
+              f"скомпилированный: {compiled * per_call:.2f} µs/ответ, ускорение x{legacy / compiled:.1f}")
+        for answer in mismatches:
+            print(f"   [{language}] расхождение: {answer!r} -> {validator.validate(answer)}")
+
+def clustered_vectors(rng, count: int, dim: int, topics: int) -> np.ndarray:
+    """Единичные векторы вокруг случайных «тем», похоже на эмбеддинги перефразированных вопросов"""
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, topics, count)] + 0.6 * rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def bench_ann(rows: int = 200000, dim: int = 384, queries: int = 500):
+    print(f"🧭 ANN индекс обученных вопросов: {rows} вопросов, размерность {dim}")
+    rng = np.random.default_rng(0)
+    vectors = clustered_vectors(rng, rows, dim, topics=rows // 50)
+    index = server.SemanticIndex(dim)
+    index.add([f"q{i}" for i in range(rows)], vectors)
+    # Запросы - зашумлённые копии существующих вопросов
+    probes = vectors[rng.integers(0, rows, queries)] + 0.05 * rng.standard_normal((queries, dim)).astype(np.float32)
+    probes /= np.linalg.norm(probes, axis=1, keepdims=True)
+    
+    started = time.perf_counter()
+    exact = [index.search(vector, 1, -1.0)[0][1] for vector in probes]
+    brute = (time.perf_counter() - started) / queries
+    print(f"   полный перебор: {brute * 1000:.2f} ms/запрос")
+    
+    started = time.perf_counter()
+    index.attach_ann(*index.build_ann())
+    # Вставки после обучения попадают в кластеры без переобучения
+    index.add([f"extra{i}" for i in range(1000)], clustered_vectors(rng, 1000, dim, topics=20))
+    print(f"   обучение k-means: {time.perf_counter() - started:.1f}s, кластеров: {len(index.ann.centroids)}")
+    
+    for nprobe in (1, 4, 8, 16, 32, 64):
+        started = time.perf_counter()
+        found = [index.search(vector, 1, -1.0, nprobe=nprobe) for vector in probes]
+        latency = (time.perf_counter() - started) / queries
+        recall = sum(bool(hits) and hits[0][1] == answer for hits, answer in zip(found, exact)) / queries
+        print(f"   nprobe={nprobe:>2}: {latency * 1000:.2f} ms/запрос, recall@1 {recall:.3f}, ускорение x{brute / latency:.1f}")
+
+BENCHMARKS = {
+    "validator": bench_validator,
+    "ann": bench_ann,
+}
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
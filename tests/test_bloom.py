@@ -0,0 +1,79 @@
+import random
+
+import numpy as np
+
+import server
+
+
+def random_items(rng, count, prefix):
+    return [f"{prefix}{rng.getrandbits(64):x}" for _ in range(count)]
+
+
+def test_no_false_negatives_across_layers():
+    rng = random.Random(0)
+    bloom = server.BloomFilter(1000, 0.01)
+    items = random_items(rng, 10000, "in:")
+    # Кусками разного размера, чтобы границы кусков не совпадали с границами слоёв
+    position = 0
+    while position < len(items):
+        step = rng.randint(1, 700)
+        bloom.add(items[position:position + step])
+        position += step
+    assert len(bloom.layers) > 1
+    assert bloom.count == len(items)
+    assert all(bloom.contains_all([item]) for item in items)
+    assert bloom.contains_all(items)
+
+
+def test_false_positive_rate_stays_near_error_rate():
+    rng = random.Random(1)
+    bloom = server.BloomFilter(1024, 0.01)
+    bloom.add(random_items(rng, 20000, "in:"))
+    misses = random_items(rng, 20000, "out:")
+    false_positives = sum(bloom.contains_all([item]) for item in misses)
+    assert false_positives / len(misses) < 0.02
+
+
+def test_layers_double_capacity_and_halve_error_rate():
+    bloom = server.BloomFilter(1024, 0.02)
+    bloom.add([str(i) for i in range(1024 + 2048 + 1)])
+    assert [layer["capacity"] for layer in bloom.layers] == [1024, 2048, 4096]
+    assert [layer["error_rate"] for layer in bloom.layers] == [0.01, 0.005, 0.0025]
+    assert [layer["count"] for layer in bloom.layers] == [1024, 2048, 1]
+    assert bloom.stats() == {"items": 3073, "layers": 3, "bytes": sum(layer["bits"].nbytes for layer in bloom.layers)}
+
+
+def test_double_hashing_positions():
+    bloom = server.BloomFilter(1024, 0.01)
+    layer = bloom.layers[0]
+    positions = server.BloomFilter._positions(layer, ["a", "b", "a"])
+    assert positions.shape == (3, layer["hashes"])
+    assert positions.dtype == np.uint64
+    assert (positions < layer["size"]).all()
+    assert (positions[0] == positions[2]).all()
+    assert not (positions[0] == positions[1]).all()
+    # Шаг нечётный и ненулевой: k позиций одного элемента не схлопываются в одну
+    assert len(set(positions[0].tolist())) > 1
+
+
+def test_contains_all_requires_every_item():
+    bloom = server.BloomFilter(1024, 0.01)
+    assert bloom.contains_all([])
+    bloom.add(["g:прив", "g:риве"])
+    assert bloom.contains_all(["g:прив", "g:риве"])
+    assert not bloom.contains_all(["g:прив", "k:missing"])
+
+
+def test_substrings_never_skipped():
+    rng = random.Random(2)
+    bloom = server.BloomFilter(1024, 0.01)
+    questions = ["".join(rng.choice("абвг дe") for _ in range(rng.randint(1, 20))) for _ in range(500)]
+    for question in questions:
+        bloom.add(server.bloom_items(question, server.question_key(question)))
+    for question in questions:
+        start = rng.randrange(len(question))
+        fragment = question[start:start + rng.randint(1, len(question))].upper()
+        assert bloom.contains_all(server.bloom_grams(fragment))
+        key = server.question_key(question)
+        if key:
+            assert bloom.contains_all([f"k:{key}"])
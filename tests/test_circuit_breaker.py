@@ -0,0 +1,97 @@
+import server
+
+
+def make_breaker(threshold=3, reset=30.0):
+    return server.CircuitBreaker("test", threshold, reset)
+
+
+def expire(breaker):
+    breaker.opened_at -= breaker.reset_timeout
+
+
+def test_opens_after_consecutive_failures():
+    breaker = make_breaker()
+    for _ in range(2):
+        assert breaker.allow_request()
+        breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+    assert breaker.short_circuited == 1
+
+
+def test_success_resets_failure_count():
+    breaker = make_breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.failures == 1
+
+
+def test_half_open_lets_one_trial_through():
+    breaker = make_breaker(threshold=1)
+    breaker.record_failure()
+    assert not breaker.is_available()
+    expire(breaker)
+    assert breaker.allow_request()
+    assert breaker.state == "half_open"
+    # Пока пробный запрос не завершён, остальные отсекаются
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow_request() and breaker.allow_request()
+
+
+def test_failed_trial_reopens():
+    breaker = make_breaker(threshold=5)
+    breaker.trip("test")
+    expire(breaker)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+
+def test_cancelled_trial_frees_the_slot():
+    breaker = make_breaker(threshold=1)
+    breaker.record_failure()
+    expire(breaker)
+    assert breaker.allow_request()
+    breaker.cancel_trial()
+    assert breaker.state == "half_open"
+    assert breaker.allow_request()
+
+
+def test_successful_probe_only_allows_a_trial():
+    breaker = make_breaker()
+    breaker.trip("generation timeouts")
+    breaker.record_probe(True)
+    assert breaker.state == "half_open"
+    assert breaker.stats()["last_probe_ok"] is True
+    assert breaker.stats()["last_probe_at"] is not None
+    # Решает настоящий запрос: перегруженная генерация снова размыкает breaker
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    breaker.record_probe(True)
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_probe_failures_go_through_threshold():
+    breaker = make_breaker(threshold=3)
+    breaker.record_probe(False)
+    breaker.record_probe(False)
+    assert breaker.state == "closed"
+    breaker.record_probe(True)
+    breaker.record_probe(False)
+    breaker.record_probe(False)
+    assert breaker.state == "closed"
+    breaker.record_probe(False)
+    assert breaker.state == "open"
+    assert breaker.stats()["probe_failures"] == 3
@@ -0,0 +1,70 @@
+from datetime import timedelta
+
+import server
+
+
+def make_store(ttl=60, max_entries=100, max_messages=3):
+    return server.ConversationStore(ttl, max_entries, max_messages)
+
+
+def idle(state, seconds):
+    state["last_activity"] -= timedelta(seconds=seconds)
+
+
+def test_get_returns_same_state_while_active():
+    store = make_store()
+    state = store.get("u1", "m")
+    state["message_count"] = 5
+    assert store.get("u1", "m") is state
+    assert store.get("u1", "other") is not state
+
+
+def test_get_expires_idle_state_before_sweep():
+    store = make_store(ttl=60)
+    state = store.get("u1", "m")
+    state["message_count"] = 5
+    idle(state, 61)
+    fresh = store.get("u1", "m")
+    assert fresh is not state
+    assert fresh["message_count"] == 0
+    assert store.expired == 1
+    assert len(store) == 1
+
+
+def test_sweep_stops_at_first_live_entry():
+    store = make_store(ttl=60)
+    states = [store.get(f"u{i}", "m") for i in range(4)]
+    idle(states[0], 120)
+    idle(states[1], 120)
+    # Живая запись u2 заслоняет истёкшую u3: чистка идёт только по началу очереди
+    idle(states[3], 120)
+    assert store.sweep() == 2
+    assert len(store) == 2
+    assert store.expired == 2
+    # После обращения u2 уходит в конец, и u3 оказывается первой
+    store.get("u2", "m")
+    assert store.sweep() == 1
+    assert len(store) == 1
+
+
+def test_lru_eviction_past_max_entries():
+    store = make_store(max_entries=3)
+    first = store.get("u0", "m")
+    store.get("u1", "m")
+    store.get("u2", "m")
+    # Обращение делает u0 самым свежим, вытесняется u1
+    assert store.get("u0", "m") is first
+    store.get("u3", "m")
+    assert len(store) == 3
+    assert store.evicted == 1
+    assert store.get("u0", "m") is first
+    assert store.get("u1", "m")["message_count"] == 0
+    assert store.stats()["evicted"] == 2
+
+
+def test_messages_deque_is_capped():
+    store = make_store(max_messages=3)
+    state = store.get("u1", "m")
+    for i in range(5):
+        state["messages"].append(f"msg{i}")
+    assert list(state["messages"]) == ["msg2", "msg3", "msg4"]
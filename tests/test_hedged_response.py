@@ -0,0 +1,83 @@
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    monkeypatch.setattr(server, "LLM_HEDGE_DELAY", 0.01)
+    monkeypatch.setattr(server, "LLM_CANDIDATES", 1)
+    monkeypatch.setattr(server, "llm_cache", server.LLMResponseCache(100, 60, 60))
+    monkeypatch.setattr(server, "llm_singleflight", server.SingleFlight())
+    monkeypatch.setattr(server, "llm_scheduler", server.LLMScheduler(4, 10, 0.01))
+    monkeypatch.setattr(server, "llm_pool", server.LLMEndpointPool([server.LLMEndpoint("http://stub", "m")]))
+    state = {"generated": 0, "trained_cancelled": False}
+
+    def configure(trained_delay, trained_answer, llm_delay, llm_answer):
+        async def get_trained_response(message, model):
+            try:
+                await asyncio.sleep(trained_delay)
+            except asyncio.CancelledError:
+                state["trained_cancelled"] = True
+                raise
+            return trained_answer
+
+        async def fetch_ollama_answer(endpoint, message, model_config, timeout=None, variant=0):
+            await asyncio.sleep(llm_delay)
+            state["generated"] += 1
+            return llm_answer
+
+        monkeypatch.setattr(server, "get_trained_response", get_trained_response)
+        monkeypatch.setattr(server, "fetch_ollama_answer", fetch_ollama_answer)
+        return state
+
+    return configure
+
+
+def model_config():
+    path = next((Path(server.__file__).parent / "models").glob("*.json"))
+    return server.ModelConfig(**json.loads(path.read_text(encoding="utf-8")))
+
+
+def cached(message):
+    return server.llm_cache.get(("m", server.normalize_message(message)))
+
+
+def test_losing_llm_wait_is_cancelled_but_generation_fills_cache(llm):
+    state = llm(trained_delay=0.05, trained_answer="из базы", llm_delay=0.15, llm_answer="от модели")
+
+    async def scenario():
+        result = await server.get_hedged_response("привет", model_config(), "m", None)
+        # Ожидание LLM отменено, но общая генерация дорабатывает до кэша
+        generated_at_return = state["generated"]
+        await asyncio.sleep(0.3)
+        return result, generated_at_return, cached("привет")
+
+    result, generated_at_return, cache_entry = asyncio.run(scenario())
+    assert result == ("из базы", "trained")
+    assert generated_at_return == 0
+    assert state["generated"] == 1
+    assert cache_entry == (True, "от модели")
+
+
+def test_slow_trained_lookup_is_cancelled_when_llm_wins(llm):
+    state = llm(trained_delay=1.0, trained_answer="из базы", llm_delay=0.02, llm_answer="от модели")
+
+    async def scenario():
+        result = await server.get_hedged_response("привет", model_config(), "m", None)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(scenario()) == ("от модели", "Ollama")
+    assert state["trained_cancelled"]
+
+
+def test_fast_trained_miss_waits_for_llm(llm):
+    state = llm(trained_delay=0, trained_answer=None, llm_delay=0.02, llm_answer="от модели")
+    assert asyncio.run(server.get_hedged_response("привет", model_config(), "m", None)) == ("от модели", "Ollama")
+    assert state["generated"] == 1
+    assert not state["trained_cancelled"]
@@ -0,0 +1,44 @@
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("message", [
+    "what do you think about me",
+    "this is nice",
+    "nothing much",
+    "which one",
+    "i want pizza",
+    "хочу есть",
+    "where do you work",
+    "привет, откуда ты?",
+    "hi, how old are you?",
+    "hey where are you from",
+    "привет, сколько тебе лет",
+])
+def test_pool_ignores_incidental_keywords(message):
+    assert server.classify_pool_intent(message) == "default"
+
+
+@pytest.mark.parametrize("message, intent", [
+    ("hi", "greetings"),
+    ("hey there!", "greetings"),
+    ("привет, как ты?", "greetings"),
+    ("how old are you?", "age_questions"),
+    ("ск лет", "age_questions"),
+    ("where are you from", "location_questions"),
+    ("откуда ты?", "location_questions"),
+    ("wanna be naughty?", "flirty"),
+])
+def test_pool_recognizes_intent_prompts(message, intent):
+    assert server.classify_pool_intent(message) == intent
+
+
+def test_cache_answer_check_does_not_count_lookups():
+    cache = server.LLMResponseCache(10, 60, 60)
+    cache.set(("m", "hi"), "Hey cutie")
+    cache.set(("m", "bad"), None)
+    assert cache.has_answer(("m", "hi"))
+    assert not cache.has_answer(("m", "bad"))
+    assert not cache.has_answer(("m", "other"))
+    assert cache.stats()["hits"] == cache.stats()["misses"] == 0
@@ -0,0 +1,79 @@
+import random
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.skipif(server.sp is None, reason="scipy не установлен")
+
+
+def random_words(rng, count):
+    return list(dict.fromkeys(
+        "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 9)))
+        for _ in range(count)
+    ))
+
+
+def test_unknown_words_never_match():
+    rng = random.Random(0)
+    words = random_words(rng, 12000)
+    known, unknown = words[:10000], words[10000:]
+    index = server.TrainedResponseIndex()
+    for i in range(3000):
+        index.upsert(" ".join(rng.sample(known, 3)), f"a{i}", 1)
+    index.keywords.merge(fold=True)
+    used = {token for question in index.docs for token in question.split()}
+    misses = [word for word in unknown if word not in used]
+    assert misses
+    assert all(index.keyword_scored(word, 0) is None for word in misses)
+
+
+def test_match_shares_a_real_token():
+    index = server.TrainedResponseIndex()
+    index.upsert("как тебя зовут", "Катя", 1)
+    index.upsert("откуда ты родом", "Москва", 1)
+    score, doc = index.keyword_scored("привет, откуда ты?", 0)
+    assert doc["answer"] == "Москва"
+    assert 0 < score <= 1
+
+
+def test_priority_breaks_ties_between_base_and_delta():
+    index = server.TrainedResponseIndex()
+    index.upsert("what is your name", "base", 9)
+    for i in range(50):
+        index.upsert(f"filler question number{i} here", "filler", 1)
+    index.keywords.merge(fold=True)
+    # Те же слова после слияния попадают в дельту и должны получить то же сходство
+    for i in range(30):
+        index.upsert(f"what is your name N{i:02d}", "copy", 1)
+    score, doc = index.keyword_scored("what your name", 0)
+    assert doc["answer"] == "base"
+    assert score == pytest.approx(1.0)
+
+
+def test_delta_rows_are_found_and_folded():
+    index = server.TrainedResponseIndex()
+    for i in range(100):
+        index.upsert(f"question{i} about weather", f"a{i}", 1)
+    index.keywords.merge(fold=True)
+    index.upsert("brand newword here", "new", 1)
+    assert index.keyword_scored("newword", 0)[1]["answer"] == "new"
+    index.keywords.merge(fold=True)
+    assert index.keyword_scored("newword", 0)[1]["answer"] == "new"
+    assert index.keyword_scored("question42", 0)[1]["answer"] == "a42"
+
+
+def test_priority_update_applies_without_new_row():
+    index = server.TrainedResponseIndex()
+    index.upsert("любимый цвет какой", "синий", 1)
+    index.upsert("какой цвет любишь", "красный", 1)
+    assert index.keyword_scored("цвет", 0)[1]["answer"] == "синий"
+    index.upsert("какой цвет любишь", "красный", 5)
+    assert index.keyword_scored("цвет", 0)[1]["answer"] == "красный"
+
+
+def test_min_score_rejects_weak_matches():
+    index = server.TrainedResponseIndex()
+    index.upsert("расскажи про свои любимые фильмы", "комедии", 1)
+    assert index.keyword_scored("фильмы", 0) is not None
+    assert index.keyword_scored("фильмы", 0.9) is None
@@ -0,0 +1,42 @@
+import pytest
+
+import server
+
+
+def test_parses_url_model_and_weight():
+    endpoints = server.parse_llm_endpoints("http://a:11434|llama3|2, http://b:11434||0.5, http://c:11434")
+    assert [(e.url, e.model, e.weight) for e in endpoints] == [
+        ("http://a:11434", "llama3", 2.0),
+        ("http://b:11434", server.OLLAMA_MODEL, 0.5),
+        ("http://c:11434", server.OLLAMA_MODEL, 1.0),
+    ]
+
+
+@pytest.mark.parametrize("item", [
+    "http://bad|m|0",
+    "http://bad|m|-1",
+    "http://bad|m|abc",
+    "http://bad|m|nan",
+    "http://bad|m|inf",
+    "http://bad|m|1|extra",
+])
+def test_invalid_entries_are_skipped(item, caplog):
+    endpoints = server.parse_llm_endpoints(f"http://good|m|1,{item}")
+    assert [e.url for e in endpoints] == ["http://good"]
+    assert "http://bad" in caplog.text
+
+
+def test_falls_back_to_default_when_nothing_is_valid(caplog):
+    endpoints = server.parse_llm_endpoints("http://bad|m|0")
+    assert [e.url for e in endpoints] == [server.OLLAMA_URL.rstrip("/")]
+    assert "нет корректных" in caplog.text
+
+
+def test_acquire_prefers_heavier_endpoint():
+    pool = server.LLMEndpointPool(server.parse_llm_endpoints("http://a|m|1,http://b|m|3"))
+    picked = []
+    for _ in range(4):
+        endpoint = pool.acquire()
+        endpoint.outstanding += 1
+        picked.append(endpoint.url)
+    assert picked.count("http://b") == 3
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("left, right", [
+    ("Привет!", "привет"),
+    ("  как   дела??? ", "Как дела"),
+    ("пpивет", "привет"),  # латинская p
+    ("hеllo", "hello"),  # кириллическая е
+    ("Ёлка", "елка"),
+    ("ＨＥＬＬＯ", "hello"),
+])
+def test_same_question_same_key(left, right):
+    assert server.question_key(left) == server.question_key(right)
+
+
+@pytest.mark.parametrize("left, right", [
+    ("вот", "bot"),
+    ("нам", "ham"),
+    ("рот", "pot"),
+    ("кто", "kto"),
+    ("мама", "mama"),
+    ("как тебя зовут", "как тебя звать"),
+])
+def test_different_words_different_keys(left, right):
+    assert server.question_key(left) != server.question_key(right)
+
+
+def test_no_key_without_letters():
+    assert server.question_key("?!... 😊") is None
+
+
+@pytest.fixture
+def mock_db(monkeypatch):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    db = mongomock_motor.AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "trained_indexes", {})
+    return db
+
+
+def test_training_lookalike_word_does_not_overwrite(mock_db):
+    async def scenario():
+        await server.save_trained_response("m", "вот", "ответ на вот", 1)
+        await server.save_trained_response("m", "bot", "ответ на bot", 1)
+        return {doc["question"]: doc["answer"] async for doc in mock_db.trained_responses.find()}
+
+    assert asyncio.run(scenario()) == {"вот": "ответ на вот", "bot": "ответ на bot"}
+
+
+def test_same_canonical_question_updates_one_record(mock_db):
+    async def scenario():
+        await server.save_trained_response("m", "привет", "первый", 1)
+        await server.save_trained_response("m", "Привет!!", "второй", 3)
+        return [(doc["question"], doc["answer"]) async for doc in mock_db.trained_responses.find()]
+
+    assert asyncio.run(scenario()) == [("привет", "второй")]
+
+
+def test_migration_rekeys_old_versions(mock_db):
+    async def scenario():
+        await mock_db.trained_responses.insert_many([
+            {"model": "m", "question": "вот", "answer": "a", "priority": 1, "question_key": "stale"},
+            {"model": "m", "question": "Вот!", "answer": "b", "priority": 5},
+            {"model": "m", "question": "bot", "answer": "c", "priority": 1},
+        ])
+        await server.migrate_question_keys()
+        return {doc["answer"]: doc.get("question_key") async for doc in mock_db.trained_responses.find()}
+
+    keys = asyncio.run(scenario())
+    assert keys["a"] is None
+    assert keys["b"] == server.question_key("вот")
+    assert keys["c"] == server.question_key("bot")
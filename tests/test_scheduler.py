@@ -0,0 +1,176 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+def test_limits_concurrency():
+    async def scenario():
+        scheduler = server.LLMScheduler(2, 10, 0.01)
+        peak = 0
+
+        async def job(remaining):
+            nonlocal peak
+            peak = max(peak, scheduler.active)
+            await asyncio.sleep(0.01)
+            return remaining
+
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(scheduler.run(job, loop.time() + 5) for _ in range(6)))
+        return scheduler, peak, results
+
+    scheduler, peak, results = asyncio.run(scenario())
+    assert peak == 2
+    assert all(0 < remaining <= 5 for remaining in results)
+    assert scheduler.admitted == 6
+    assert scheduler.active == 0 and scheduler.waiting == 0
+
+
+def test_rejects_when_queue_is_full():
+    async def scenario():
+        scheduler = server.LLMScheduler(1, 1, 0.01)
+        release = asyncio.Event()
+
+        async def job(remaining):
+            await release.wait()
+
+        loop = asyncio.get_running_loop()
+        running = [asyncio.create_task(scheduler.run(job, loop.time() + 5)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        with pytest.raises(server.LLMAdmissionRejected):
+            await scheduler.run(job, loop.time() + 5)
+        release.set()
+        await asyncio.gather(*running)
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.rejected_queue_full == 1
+    assert scheduler.admitted == 2
+
+
+def test_rejects_requests_that_cannot_meet_deadline():
+    async def scenario():
+        scheduler = server.LLMScheduler(1, 10, 1.0)
+        loop = asyncio.get_running_loop()
+
+        async def job(remaining):
+            return remaining
+
+        # Средняя генерация 1s, а до дедлайна полсекунды: в очередь не ставим
+        with pytest.raises(server.LLMAdmissionRejected):
+            await scheduler.run(job, loop.time() + 0.5)
+        return scheduler, await scheduler.run(job, loop.time() + 2)
+
+    scheduler, remaining = asyncio.run(scenario())
+    assert scheduler.rejected_deadline == 1
+    assert scheduler.admitted == 1
+    assert remaining > 1
+
+
+def test_estimated_wait_counts_rounds_ahead():
+    scheduler = server.LLMScheduler(2, 10, 1.0)
+    assert scheduler.estimated_wait() == 0
+    scheduler.active = 2
+    assert scheduler.estimated_wait() == 1.0
+    scheduler.waiting = 2
+    assert scheduler.estimated_wait() == 2.0
+
+
+def test_deadline_expires_in_queue():
+    async def scenario():
+        scheduler = server.LLMScheduler(1, 10, 0.01)
+        release = asyncio.Event()
+
+        async def slow(remaining):
+            await release.wait()
+
+        loop = asyncio.get_running_loop()
+        running = asyncio.create_task(scheduler.run(slow, loop.time() + 5))
+        await asyncio.sleep(0.01)
+        with pytest.raises(server.LLMAdmissionRejected):
+            await scheduler.run(slow, loop.time() + 0.05)
+        release.set()
+        await running
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.expired_in_queue == 1
+    assert scheduler.waiting == 0
+    assert scheduler.stats()["admitted"] == 1
+
+
+def test_queue_wait_leaves_time_for_generation():
+    async def scenario():
+        scheduler = server.LLMScheduler(1, 10, 0.1)
+        release = asyncio.Event()
+
+        async def slow(remaining):
+            await release.wait()
+
+        loop = asyncio.get_running_loop()
+        running = asyncio.create_task(scheduler.run(slow, loop.time() + 5))
+        await asyncio.sleep(0.01)
+        started = loop.time()
+        with pytest.raises(server.LLMAdmissionRejected):
+            await scheduler.run(slow, started + 0.3)
+        waited = loop.time() - started
+        release.set()
+        await running
+        return scheduler, waited
+
+    scheduler, waited = asyncio.run(scenario())
+    assert scheduler.expired_in_queue == 1
+    # Очередь отпускает запрос за avg_latency до дедлайна
+    assert waited < 0.25
+
+
+def test_deadline_timeouts_do_not_open_breaker():
+    async def scenario():
+        # Оценка латентности устарела: реальная генерация 0.3s, а дедлайны наступают сразу после освобождения слота
+        scheduler = server.LLMScheduler(1, 10, 0.05)
+        endpoint = server.LLMEndpoint("http://busy", "m")
+        pool = server.LLMEndpointPool([endpoint])
+
+        async def generate(endpoint):
+            await asyncio.sleep(0.3)
+            return "ok"
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 0.4
+        requests = [
+            scheduler.run(lambda remaining: pool.run(generate, remaining), deadline)
+            for _ in range(1 + max(server.OLLAMA_BREAKER_FAILURES, 3))
+        ]
+        results = await asyncio.gather(*requests, return_exceptions=True)
+        return endpoint, results
+
+    endpoint, results = asyncio.run(scenario())
+    assert results[0] == "ok"
+    assert all(isinstance(result, (server.LLMAdmissionRejected, asyncio.TimeoutError)) for result in results[1:])
+    assert endpoint.breaker.state == "closed"
+    assert endpoint.failures == 0
+
+
+def test_backend_errors_still_count_against_breaker(monkeypatch):
+    monkeypatch.setattr(server, "OLLAMA_TIMEOUT", 0.05)
+
+    async def scenario():
+        endpoint = server.LLMEndpoint("http://down", "m")
+        pool = server.LLMEndpointPool([endpoint])
+
+        async def hang(endpoint):
+            await asyncio.sleep(1)
+
+        async def refuse(endpoint):
+            raise server.httpx.ConnectError("refused")
+
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(hang, server.OLLAMA_TIMEOUT)
+        with pytest.raises(server.httpx.ConnectError):
+            await pool.run(refuse, 0.01)
+        return endpoint
+
+    endpoint = asyncio.run(scenario())
+    assert endpoint.failures == 2
+    assert endpoint.deadline_timeouts == 0
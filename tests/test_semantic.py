@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+
+import numpy as np
+
+import server
+
+
+class StubEncoder:
+    """Детерминированные векторы по тексту вместо sentence-transformers"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.encoded = 0
+
+    def get_sentence_embedding_dimension(self):
+        return 16
+
+    def encode(self, texts, **kwargs):
+        self.encoded += len(texts)
+        if self.delay:
+            import time
+            time.sleep(self.delay)
+        vectors = np.array([
+            np.random.default_rng(int(hashlib.md5(text.encode()).hexdigest()[:8], 16)).standard_normal(16)
+            for text in texts
+        ], dtype=np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class RecordingEncoder(StubEncoder):
+    """Запоминает размер каждой пачки и число одновременных вызовов"""
+
+    def __init__(self, delay: float = 0.0, error: Exception = None):
+        super().__init__(delay)
+        self.error = error
+        self.batches = []
+        self.active = 0
+        self.max_active = 0
+
+    def encode(self, texts, **kwargs):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            self.batches.append(len(texts))
+            if self.error:
+                raise self.error
+            return super().encode(texts)
+        finally:
+            self.active -= 1
+
+
+def make_matcher(tmp_path, encoder):
+    matcher = server.SemanticMatcher("stub", server.EmbeddingStore(tmp_path))
+    matcher.encoder = encoder
+    return matcher
+
+
+def trained(questions):
+    index = server.TrainedResponseIndex()
+    for question in questions:
+        index.upsert(question, f"answer to {question}", 1)
+    return index
+
+
+def test_questions_trained_during_build_are_indexed(tmp_path):
+    async def scenario():
+        matcher = make_matcher(tmp_path, StubEncoder(delay=0.2))
+        indexes = {"m": trained(["как тебя зовут", "сколько тебе лет"])}
+        build = asyncio.create_task(matcher.build(indexes))
+        await asyncio.sleep(0.05)
+        # Пока идёт кодирование: новый вопрос у существующей модели и новая модель
+        matcher.queue("m", "откуда ты родом")
+        matcher.queue("new_model", "любимый цвет")
+        await build
+        return matcher
+
+    matcher = asyncio.run(scenario())
+    assert matcher.ready
+    assert not matcher.pending
+    assert "откуда ты родом" in matcher.indexes["m"].rows
+    assert "любимый цвет" in matcher.indexes["new_model"].rows
+
+
+
+def test_snapshot_reuses_vectors_on_restart(tmp_path):
+    async def scenario(questions):
+        encoder = StubEncoder()
+        matcher = make_matcher(tmp_path, encoder)
+        await matcher.build({"m": trained(questions)})
+        return matcher, encoder
+
+    asyncio.run(scenario(["a b", "c d"]))
+    matcher, encoder = asyncio.run(scenario(["a b", "c d", "e f"]))
+    assert encoder.encoded == 1
+    vector = StubEncoder().encode(["c d"])[0]
+    assert matcher.indexes["m"].search(vector, 1, 0.99)[0][1] == "c d"
+
+
+def test_concurrent_saves_of_same_version_do_not_share_a_file(tmp_path):
+    store = server.EmbeddingStore(tmp_path)
+    first = np.ones((1, 4), dtype=np.float32)
+    second = np.full((2, 4), 2, dtype=np.float32)
+    # Оба воркера прочитали отсутствующий манифест и пишут версию 1
+    store.save("m", "stub", first, ["a"])
+    manifest = (tmp_path / "m.json").read_text(encoding="utf-8")
+    (tmp_path / "m.json").unlink()
+    store.save("m", "stub", second, ["b", "c"])
+
+    assert len(list(tmp_path.glob("m.v1.*.npy"))) == 2
+    vectors, questions = store.load("m", "stub", 4)
+    assert questions == ["b", "c"]
+    assert vectors.shape == (2, 4)
+    assert "m.v1." in manifest
+
+
+def test_old_snapshots_are_pruned_and_unlink_errors_ignored(tmp_path, monkeypatch):
+    store = server.EmbeddingStore(tmp_path)
+    vectors = np.ones((1, 4), dtype=np.float32)
+    for _ in range(3):
+        store.save("m", "stub", vectors, ["a"])
+    assert sorted(p.name.split(".")[1] for p in tmp_path.glob("m.v*.npy")) == ["v2", "v3"]
+
+    def locked(self, missing_ok=False):
+        raise PermissionError("mapped by another process")
+
+    monkeypatch.setattr(type(tmp_path), "unlink", locked)
+    store.save("m", "stub", vectors, ["a"])
+    assert store.load("m", "stub", 4)[1] == ["a"]
+
+
+def run_batcher(encoder, max_batch, max_wait, texts, stagger=0.0):
+    async def scenario():
+        batcher = server.EncodingBatcher(encoder.encode, max_batch, max_wait)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        calls = []
+        for text in texts:
+            calls.append(asyncio.ensure_future(batcher.encode(text)))
+            if stagger:
+                await asyncio.sleep(stagger)
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        return batcher, results, loop.time() - started
+
+    return asyncio.run(scenario())
+
+
+def test_batcher_dispatches_full_batch_without_waiting():
+    encoder = RecordingEncoder()
+    texts = ["a", "b", "c", "d"]
+    batcher, results, elapsed = run_batcher(encoder, 4, 10.0, texts)
+    assert encoder.batches == [4]
+    assert elapsed < 1
+    for text, vector in zip(texts, results):
+        assert np.allclose(vector, StubEncoder().encode([text])[0])
+
+
+def test_batcher_dispatches_partial_batch_on_timer():
+    encoder = RecordingEncoder()
+    batcher, results, elapsed = run_batcher(encoder, 100, 0.05, ["a", "b", "c"])
+    assert encoder.batches == [3]
+    assert elapsed >= 0.05
+    assert batcher.stats()["avg_batch"] == 3
+
+
+def test_batches_pile_up_while_encoding():
+    encoder = RecordingEncoder(delay=0.05)
+    texts = [f"text {i}" for i in range(7)]
+    # Первое сообщение уходит по таймеру, остальные приходят, пока оно кодируется
+    batcher, results, elapsed = run_batcher(encoder, 3, 0.001, texts, stagger=0.01)
+    assert encoder.max_active == 1
+    assert encoder.batches[0] == 1
+    assert sum(encoder.batches) == len(texts)
+    assert all(size <= 3 for size in encoder.batches)
+    assert len(encoder.batches) < len(texts)
+    assert batcher.stats()["largest_batch"] == 3
+    assert all(np.allclose(vector, StubEncoder().encode([text])[0]) for text, vector in zip(texts, results))
+
+
+def test_batcher_error_reaches_every_caller():
+    async def scenario():
+        encoder = RecordingEncoder(error=RuntimeError("encoder failed"))
+        batcher = server.EncodingBatcher(encoder.encode, 3, 0.01)
+        results = await asyncio.gather(*(batcher.encode(text) for text in "abcde"), return_exceptions=True)
+        # После ошибки батчер продолжает работать
+        encoder.error = None
+        return encoder, batcher, results, await batcher.encode("a")
+
+    encoder, batcher, results, vector = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert encoder.batches == [3, 2, 1]
+    assert batcher.stats()["pending"] == 0
+    assert np.allclose(vector, StubEncoder().encode(["a"])[0])
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+def test_concurrent_identical_keys_run_once():
+    async def scenario():
+        flight = server.SingleFlight()
+        calls = 0
+
+        async def func():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return "answer"
+
+        results = await asyncio.gather(*(flight.do("k", func) for _ in range(5)), flight.do("other", func))
+        return flight, calls, results
+
+    flight, calls, results = asyncio.run(scenario())
+    assert results == ["answer"] * 6
+    assert calls == 2
+    assert flight.stats() == {"inflight": 0, "leaders": 2, "coalesced": 4}
+
+
+def test_cancelling_one_waiter_keeps_shared_task():
+    async def scenario():
+        flight = server.SingleFlight()
+        finished = asyncio.Event()
+
+        async def func():
+            await asyncio.sleep(0.05)
+            finished.set()
+            return "answer"
+
+        first = asyncio.ensure_future(flight.do("k", func))
+        second = asyncio.ensure_future(flight.do("k", func))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second, finished.is_set()
+
+    assert asyncio.run(scenario()) == ("answer", True)
+
+
+def test_exception_reaches_every_waiter_and_frees_key():
+    async def scenario():
+        flight = server.SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("backend down")
+
+        async def succeed():
+            return "answer"
+
+        results = await asyncio.gather(flight.do("k", fail), flight.do("k", fail), return_exceptions=True)
+        return results, await flight.do("k", succeed)
+
+    results, retry = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retry == "answer"
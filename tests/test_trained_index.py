@@ -0,0 +1,122 @@
+import random
+
+import pytest
+
+import server
+
+
+class NaiveTrainedResponses:
+    """Прежние запросы к Mongo: $regex без учёта регистра, сортировка по priority, при равенстве - порядок вставки"""
+
+    def __init__(self):
+        self.docs = []
+
+    def upsert(self, question, answer, priority):
+        for doc in self.docs:
+            if doc["question"] == question:
+                doc.update(answer=answer, priority=priority)
+                return
+        self.docs.append({"question": question, "answer": answer, "priority": priority})
+
+    def _best(self, fragment):
+        matches = [doc for doc in self.docs if fragment in doc["question"].lower()]
+        return max(matches, key=lambda doc: doc["priority"], default=None)
+
+    def exact(self, question):
+        return next((doc for doc in self.docs if doc["question"] == question), None)
+
+    def keyword(self, word):
+        return self._best(word)
+
+    def partial(self, message_lower):
+        return self._best(message_lower)
+
+
+def random_text(rng, alphabet, words):
+    return " ".join(
+        "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 6)))
+        for _ in range(rng.randint(1, words))
+    )
+
+
+def question_of(doc):
+    return doc["question"] if doc else None
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_index_matches_naive_mongo_queries(seed):
+    rng = random.Random(seed)
+    # Маленький алфавит, чтобы подстроки и совпадения приоритетов встречались часто
+    alphabet = rng.choice(["abc", "abcd", "абв", "aбcВ"])
+    index = server.TrainedResponseIndex()
+    naive = NaiveTrainedResponses()
+    questions = []
+    for i in range(rng.randint(1, 40)):
+        if questions and rng.random() < 0.2:
+            question = rng.choice(questions)
+        else:
+            question = random_text(rng, alphabet, 4)
+            questions.append(question)
+        priority = rng.randint(1, 3)
+        index.upsert(question, f"a{i}", priority)
+        naive.upsert(question, f"a{i}", priority)
+
+    for _ in range(30):
+        if rng.random() < 0.3:
+            message = rng.choice(questions)
+            start = rng.randrange(len(message))
+            message = message[start:start + rng.randint(1, len(message))].strip()
+        else:
+            message = random_text(rng, alphabet, 3)
+        message_lower = message.lower()
+        assert question_of(index.exact(message)) == question_of(naive.exact(message))
+        for word in message_lower.split():
+            assert question_of(index.keyword(word)) == question_of(naive.keyword(word)), word
+        assert question_of(index.partial(message_lower)) == question_of(naive.partial(message_lower)), message
+
+
+def brute_force_fuzzy(index, message, threshold):
+    grams = server.fuzzy_trigrams(message)
+    best = None
+    for doc in index.docs.values():
+        if not grams or not doc["grams"]:
+            continue
+        score = 2 * len(grams & doc["grams"]) / (len(grams) + len(doc["grams"]))
+        if score >= threshold and (best is None or (score, -doc["priority"], -doc["seq"]) > (best[0], -best[1]["priority"], -best[1]["seq"])):
+            best = (score, doc)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_fuzzy_matches_brute_force_dice(seed):
+    rng = random.Random(seed)
+    alphabet = rng.choice(["abc", "abcde", "абвгд", "ab!c"])
+    threshold = rng.choice([0.3, 0.5, 0.7, 0.9, 1.0])
+    index = server.TrainedResponseIndex()
+    questions = []
+    for i in range(rng.randint(1, 40)):
+        question = random_text(rng, alphabet, 4)
+        questions.append(question)
+        index.upsert(question, f"a{i}", rng.randint(1, 3))
+
+    for _ in range(30):
+        message = rng.choice(questions)
+        # Опечатки: замена, вставка и удаление символов
+        for _ in range(rng.randint(0, 3)):
+            position = rng.randint(0, len(message))
+            edit = rng.choice(["replace", "insert", "delete"])
+            tail = position + (edit != "insert")
+            message = message[:position] + ("" if edit == "delete" else rng.choice(alphabet)) + message[tail:]
+        expected = brute_force_fuzzy(index, message, threshold)
+        found = index.fuzzy(message, threshold)
+        assert (found and (found[0], found[1]["question"])) == (expected and (expected[0], expected[1]["question"])), message
+
+
+def test_fuzzy_tolerates_typos_and_repeats():
+    index = server.TrainedResponseIndex()
+    index.upsert("как тебя зовут", "Катя", 1)
+    index.upsert("откуда ты родом", "Москва", 1)
+    score, doc = index.fuzzy("как тибя зовуут!!", 0.7)
+    assert doc["answer"] == "Катя"
+    assert 0.7 <= score < 1
+    assert index.fuzzy("сколько тебе лет", 0.7) is None
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def mock_db(monkeypatch):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    db = mongomock_motor.AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "TRAINED_INDEX_ENABLED", True)
+    monkeypatch.setattr(server, "trained_indexes", {})
+    monkeypatch.setattr(server, "trained_indexes_loaded", False)
+    monkeypatch.setattr(server, "trained_blooms", {})
+    monkeypatch.setattr(server, "trained_blooms_loaded", False)
+    monkeypatch.setattr(server, "trained_sync_state", {})
+    monkeypatch.setattr(server, "trained_sync_stats", {"polls": 0, "applied": 0})
+    monkeypatch.setattr(server.semantic_matcher, "enabled", False)
+    return db
+
+
+async def write_late(db, model, question, answer, version):
+    # Вторая половина save_trained_response: документ с уже выданной версией
+    await db.trained_responses.update_one(
+        {"model": model, "question_key": server.question_key(question)},
+        {"$set": {"answer": answer, "priority": 1, "version": version}, "$setOnInsert": {"question": question}},
+        upsert=True
+    )
+
+
+def test_write_lagging_behind_load_is_picked_up(mock_db):
+    async def scenario():
+        await server.save_trained_response("m", "как тебя зовут", "Катя", 1)
+        # Другой воркер увеличил счётчик до загрузки, а документ записал уже после обхода
+        version = await server.bump_trained_version("m")
+        await server.load_trained_indexes()
+        assert server.trained_indexes["m"].exact("откуда ты") is None
+        await write_late(mock_db, "m", "откуда ты", "Москва", version)
+        await server.sync_trained_indexes()
+        return server.trained_indexes["m"].exact("откуда ты")
+
+    doc = asyncio.run(scenario())
+    assert doc["answer"] == "Москва"
+
+
+def test_write_lagging_behind_counter_is_read_on_second_poll(mock_db):
+    async def scenario():
+        await server.save_trained_response("m", "как тебя зовут", "Катя", 1)
+        await server.load_trained_indexes()
+        await server.sync_trained_indexes()
+        version = await server.bump_trained_version("m")
+        await server.sync_trained_indexes()
+        missing = server.trained_indexes["m"].exact("откуда ты")
+        await write_late(mock_db, "m", "откуда ты", "Москва", version)
+        await server.sync_trained_indexes()
+        found = server.trained_indexes["m"].exact("откуда ты")
+        # После двух опросов диапазон подтверждён и больше не перечитывается
+        applied = server.trained_sync_stats["applied"]
+        await server.sync_trained_indexes()
+        return missing, found, applied, server.trained_sync_stats["applied"], server.trained_sync_state["m"]
+
+    missing, found, applied, applied_after, state = asyncio.run(scenario())
+    assert missing is None
+    assert found["answer"] == "Москва"
+    assert applied_after == applied
+    assert state == {"seen": 2, "confirmed": 2}
+
+
+def test_bloom_load_picks_up_lagging_write(mock_db, monkeypatch):
+    monkeypatch.setattr(server, "TRAINED_INDEX_ENABLED", False)
+
+    async def scenario():
+        await server.save_trained_response("m", "как тебя зовут", "Катя", 1)
+        version = await server.bump_trained_version("m")
+        await server.load_trained_blooms()
+        await write_late(mock_db, "m", "откуда ты", "Москва", version)
+        await server.sync_trained_indexes()
+
+    asyncio.run(scenario())
+    assert server.trained_blooms["m"].contains_all([f"k:{server.question_key('откуда ты')}"])
@@ -0,0 +1,67 @@
+import json
+import random
+from pathlib import Path
+
+import pytest
+
+import server
+
+MODELS_DIR = Path(server.__file__).parent / "models"
+
+
+def load_config(**overrides):
+    data = json.loads(next(MODELS_DIR.glob("*.json")).read_text(encoding="utf-8"))
+    data.update(overrides)
+    return server.ModelConfig(**data)
+
+
+def old_match(message_lower, triggers):
+    # Прежний цикл из generate_ai_response, без пустых триггеров: они срабатывали на любое сообщение
+    for trigger in triggers:
+        key = trigger.lower().strip()
+        if key and key in message_lower:
+            return trigger
+    return None
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_old_loop(seed):
+    rng = random.Random(seed)
+    alphabet = rng.choice(["ab", "abc ", "snapchti ", "аб.в "])
+    triggers = [
+        "".join(rng.choice(alphabet + "AБ") for _ in range(rng.randint(0, 5)))
+        for _ in range(rng.randint(0, 8))
+    ]
+    config = load_config(triggers=triggers)
+    for _ in range(30):
+        message = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+        expected = old_match(message, triggers)
+        found = server.match_trigger(message, config)
+        assert (found is None) == (expected is None), (triggers, message)
+        if found is not None:
+            assert found in triggers
+            assert found.lower().strip() in message
+
+
+def test_real_persona_triggers():
+    for path in MODELS_DIR.glob("*.json"):
+        config = server.ModelConfig(**json.loads(path.read_text(encoding="utf-8")))
+        for trigger in config.triggers:
+            message = f"hey, {trigger.lower().strip()}?"
+            assert (server.match_trigger(message, config) is None) == (old_match(message, config.triggers) is None)
+
+
+def test_word_boundary():
+    config = load_config(triggers=["snap", "Insta"], trigger_word_boundary=True)
+    assert server.match_trigger("add me on snapchat", config) is None
+    assert server.match_trigger("my snap is kate", config) == "snap"
+    assert server.match_trigger("insta?", config) == "Insta"
+    assert server.match_trigger("instagram", config) is None
+
+    config = load_config(triggers=["snap"])
+    assert server.match_trigger("add me on snapchat", config) == "snap"
+
+
+def test_empty_triggers_never_match():
+    config = load_config(triggers=["", "   "])
+    assert server.match_trigger("anything", config) is None